@@ -0,0 +1,103 @@
+"""Allocation measurements for computing one dashboard.
+
+Runs compute_dashboard for a fixed set of filter states without any result cache
+and reports, per state, the traced peak and retained memory, the number of
+allocated blocks and the garbage collections triggered. The "aggregates" rows
+leave out figure building to isolate the backend aggregation layer; the
+"comparison" rows add the same period of the previous year.
+
+    python allocations.py [--backend pandas|sqlite] [--repeat 5]
+"""
+
+import argparse
+import gc
+import time
+import tracemalloc
+
+from analytics import compute_aggregates, compute_dashboard
+from backends import create_backend
+from cache import filter_key
+
+########################################################################################
+##################################### Measurement ######################################
+########################################################################################
+
+
+def gc_collections():
+    return sum(generation["collections"] for generation in gc.get_stats())
+
+
+# Run function(*args) under tracemalloc and return its allocation statistics
+def measure(function, *args):
+    gc.collect()
+    collections = gc_collections()
+    tracemalloc.start()
+    started = time.perf_counter()
+    try:
+        result = function(*args)
+        seconds = time.perf_counter() - started
+        retained, peak = tracemalloc.get_traced_memory()
+        blocks = sum(
+            stat.count for stat in tracemalloc.take_snapshot().statistics("filename")
+        )
+    finally:
+        tracemalloc.stop()
+    del result
+    return {
+        "peak_bytes": peak,
+        "retained_bytes": retained,
+        "blocks": blocks,
+        "gc_collections": gc_collections() - collections,
+        "seconds": seconds,
+    }
+
+
+def filter_states(backend):
+    min_date, max_date = backend.date_bounds()
+    countries = backend.options("Country")
+    categories = backend.options("Category")
+    return {
+        "default": filter_key(min_date, max_date, None, None),
+        "one_country": filter_key(min_date, max_date, countries[:1], None),
+        "one_category": filter_key(min_date, max_date, None, categories[:1]),
+        "one_month": filter_key("2021-03-01", "2021-03-31", countries[:3], None),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--backend", choices=["pandas", "sqlite"], default="pandas")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    backend = create_backend(args.backend)
+    # Warm up imports, plotly templates and lazily built backend state
+    compute_dashboard(backend, *filter_states(backend)["default"])
+
+    print(
+        f"{'stage':<12}{'filters':<14}{'peak KB':>10}{'retained KB':>13}"
+        f"{'blocks':>9}{'gc runs':>9}{'ms':>9}"
+    )
+    for stage, function in [
+        ("aggregates", lambda backend, *filters: compute_aggregates(backend, filters)),
+        (
+            "comparison",
+            lambda backend, *filters: compute_aggregates(
+                backend, filters, comparison="previous_year"
+            ),
+        ),
+        ("dashboard", compute_dashboard),
+    ]:
+        for name, filters in filter_states(backend).items():
+            runs = [measure(function, backend, *filters) for _ in range(args.repeat)]
+            # Report the median run
+            run = sorted(runs, key=lambda run: run["peak_bytes"])[len(runs) // 2]
+            print(
+                f"{stage:<12}{name:<14}{run['peak_bytes'] / 1024:>10.0f}"
+                f"{run['retained_bytes'] / 1024:>13.0f}{run['blocks']:>9}"
+                f"{run['gc_collections']:>9}{run['seconds'] * 1000:>9.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
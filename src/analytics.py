@@ -0,0 +1,234 @@
+import json
+
+import numpy as np
+import pandas as pd
+from plotly.utils import PlotlyJSONEncoder
+
+from backends import time_granularity
+from cache import comparison_modes, filter_key
+from graphs import dashboard_graph_builders, get_time_series_graphs
+
+########################################################################################
+################################## Compute dashboard ###################################
+########################################################################################
+
+
+# The prior window to compare the selected dates against: the equally long range
+# right before it, or the same dates one year earlier
+def comparison_window(start_date, end_date, comparison):
+    start_date, end_date = pd.Timestamp(start_date), pd.Timestamp(end_date)
+    if comparison == "previous_year":
+        prior_start = start_date - pd.DateOffset(years=1)
+        prior_end = end_date - pd.DateOffset(years=1)
+    else:
+        prior_end = start_date - pd.Timedelta(days=1)
+        prior_start = prior_end - (end_date - start_date)
+    return prior_start.strftime("%Y-%m-%d"), prior_end.strftime("%Y-%m-%d")
+
+
+# Move prior period labels onto the current window so both lines share the x axis
+def shift_periods(periods, freq, start_date, prior_start):
+    unit = "D" if freq == "D" else "M"
+    shift = np.datetime64(start_date[:10], unit) - np.datetime64(prior_start, unit)
+    return np.datetime_as_string(
+        periods.to_numpy().astype(f"datetime64[{unit}]") + shift
+    )
+
+
+# The numbers shared by the dashboard and the query API, so they always match. With a
+# comparison mode the backend evaluates the selected and the prior window together.
+def compute_aggregates(backend, filters, top_n=5, comparison=None):
+    freq, period = time_granularity(backend.date_range(filters))
+    prior = None
+    if comparison is None:
+        kpis = backend.kpis(filters)
+        time_series = backend.time_series(filters, freq)
+    else:
+        prior_start, prior_end = comparison_window(filters[0], filters[1], comparison)
+        current, prior = backend.compare(filters, prior_start, prior_end, freq)
+        kpis = current["kpis"]
+        time_series = current["time_series"]
+        prior["label"] = comparison_modes[comparison]
+        prior["time_series"] = prior["time_series"].assign(
+            **{
+                "Prior.Period": prior["time_series"]["Period"],
+                "Period": shift_periods(
+                    prior["time_series"]["Period"], freq, filters[0], prior_start
+                ),
+            }
+        )
+    return {
+        "kpis": kpis,
+        "top_products": backend.top_products(filters, top_n),
+        "period": period,
+        "time_series": time_series,
+        "prior": prior,
+    }
+
+
+# Evaluate many filter states at once for the query API, in one pass of the backend
+# (see QueryBackend.batch) over the distinct states. Same results as
+# compute_aggregates without a comparison.
+def compute_batch(backend, filter_states, top_n=5):
+    distinct = list(dict.fromkeys(filter_states))
+    results = dict(zip(distinct, backend.batch(distinct, top_n)))
+    return [{**results[filters], "prior": None} for filters in filter_states]
+
+
+########################################################################################
+################################## Dashboard sections ##################################
+########################################################################################
+
+# Dependency graph of the dashboard: the filter dimensions each section depends on.
+# Besides the date picker and dropdowns, a click or selection on the map narrows the
+# countries ("map_countries") and a click on the category pie narrows the categories
+# ("pie_categories"). A chart never depends on its own cross-filter, so it stays as
+# it is when clicked, and only the sections depending on a changed dimension have to
+# be recomputed.
+section_dimensions = {
+    # KPIs, top products and the sales and profit time series
+    "summary": {
+        "dates",
+        "countries",
+        "categories",
+        "comparison",
+        "map_countries",
+        "pie_categories",
+    },
+    "sales-category": {"dates", "countries", "categories", "map_countries"},
+    "customer-heatmap": {"dates", "countries", "categories", "pie_categories"},
+    "shipping-comparison": {
+        "dates",
+        "countries",
+        "categories",
+        "map_countries",
+        "pie_categories",
+    },
+}
+
+
+# Cache key of every section for one dashboard state: the section name, the filters
+# that apply to it and its comparison mode. Sections share entries across states that
+# only differ in dimensions they do not depend on.
+def section_keys(
+    start_date,
+    end_date,
+    selected_countries,
+    selected_categories,
+    comparison=None,
+    map_countries=(),
+    pie_categories=(),
+):
+    keys = {}
+    for section, dimensions in section_dimensions.items():
+        if map_countries and "map_countries" in dimensions:
+            countries = map_countries
+        else:
+            countries = selected_countries
+        if pie_categories and "pie_categories" in dimensions:
+            categories = pie_categories
+        else:
+            categories = selected_categories
+        keys[section] = (
+            section,
+            *filter_key(start_date, end_date, countries, categories),
+            comparison if "comparison" in dimensions else None,
+        )
+    return keys
+
+
+def compute_section(
+    backend,
+    section,
+    start_date,
+    end_date,
+    selected_countries,
+    selected_categories,
+    comparison=None,
+):
+    filters = (start_date, end_date, selected_countries, selected_categories)
+    if section != "summary":
+        return {
+            "figures": {section: dashboard_graph_builders[section](backend, filters)}
+        }
+
+    # Get the top 5 products by sales
+    aggregates = compute_aggregates(backend, filters, 5, comparison)
+    return {
+        "kpis": aggregates["kpis"],
+        "prior_kpis": aggregates["prior"] and aggregates["prior"]["kpis"],
+        "top_products": aggregates["top_products"],
+        "figures": get_time_series_graphs(aggregates),
+    }
+
+
+# Sections with a first, approximate answer from a backends.SampleBackend while the
+# exact one is computed. The map counts distinct customers, which a sample cannot
+# estimate, so it only shows the exact result.
+approximate_sections = ["summary", "sales-category", "shipping-comparison"]
+
+
+def compute_approximate_section(
+    sample,
+    section,
+    start_date,
+    end_date,
+    selected_countries,
+    selected_categories,
+    comparison=None,
+):
+    filters = (start_date, end_date, selected_countries, selected_categories)
+    result = compute_section(sample, section, *filters, comparison)
+    if section == "summary":
+        result["kpi_errors"] = sample.kpi_errors(filters)
+    return result
+
+
+# Everything update_dashboard shows for one filter state without cross-filters
+def compute_dashboard(
+    backend,
+    start_date,
+    end_date,
+    selected_countries,
+    selected_categories,
+    comparison=None,
+):
+    filters = (start_date, end_date, selected_countries, selected_categories)
+    dashboard = {"figures": {}}
+    for section in section_dimensions:
+        result = compute_section(backend, section, *filters, comparison)
+        dashboard["figures"].update(result.pop("figures"))
+        dashboard.update(result)
+    return dashboard
+
+
+########################################################################################
+############################### Serialize dashboard ####################################
+########################################################################################
+
+
+# JSON round trip for the disk cache, for whole dashboards and single sections. Figures
+# come back as plain dicts, which Dash accepts wherever it accepts a go.Figure.
+def dashboard_to_json(dashboard):
+    dashboard = dict(dashboard)
+    if "top_products" in dashboard:
+        dashboard["top_products"] = dashboard["top_products"].to_dict("list")
+    return json.dumps(dashboard, cls=PlotlyJSONEncoder)
+
+
+def kpis_from_json(kpis):
+    # NaN KPIs (e.g. the mean of an empty selection) are encoded as null
+    return {
+        name: float("nan") if value is None else value for name, value in kpis.items()
+    }
+
+
+def dashboard_from_json(text):
+    dashboard = json.loads(text)
+    if "kpis" in dashboard:
+        dashboard["kpis"] = kpis_from_json(dashboard["kpis"])
+    if dashboard.get("prior_kpis") is not None:
+        dashboard["prior_kpis"] = kpis_from_json(dashboard["prior_kpis"])
+    if "top_products" in dashboard:
+        dashboard["top_products"] = pd.DataFrame(dashboard["top_products"])
+    return dashboard
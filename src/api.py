@@ -0,0 +1,428 @@
+import hashlib
+import importlib.util
+import io
+import json
+import math
+import os
+import sys
+from datetime import date
+from functools import lru_cache
+
+from flask import Blueprint, Response, jsonify, request, stream_with_context
+
+from cache import comparison_modes, filter_key, source_fingerprint
+from datasets import UnknownDataset
+
+########################################################################################
+################################### Request parsing ####################################
+########################################################################################
+
+
+class BadRequest(Exception):
+    pass
+
+
+# YYYY-MM-DD of a date, which may also come with a time part or in another ISO 8601
+# form (e.g. 20210101), the form the backends compare against
+def parse_date(value):
+    try:
+        return date.fromisoformat(str(value)[:10]).isoformat()
+    except ValueError:
+        raise BadRequest(f"Invalid date: {value}") from None
+
+
+def parse_filters(backend, start_date, end_date, countries, categories):
+    # Missing dates default to the full range of the dataset
+    if not start_date or not end_date:
+        min_date, max_date = backend.date_bounds()
+        start_date = start_date or min_date.isoformat()
+        end_date = end_date or max_date.isoformat()
+    start_date = parse_date(start_date)
+    end_date = parse_date(end_date)
+    if start_date > end_date:
+        raise BadRequest(f"start_date {start_date} is after end_date {end_date}")
+    for values in (countries, categories):
+        if not isinstance(values, list) or not all(
+            isinstance(value, str) for value in values
+        ):
+            raise BadRequest("countries and categories must be lists of strings")
+    return filter_key(start_date, end_date, countries, categories)
+
+
+# Same filters as update_dashboard, from ?start_date=&end_date=&country=&category=
+# (country and category may be repeated)
+def request_filters(backend, args):
+    return parse_filters(
+        backend,
+        args.get("start_date"),
+        args.get("end_date"),
+        args.getlist("country"),
+        args.getlist("category"),
+    )
+
+
+def request_columns(backend, args):
+    # ?columns=Order.ID,Sales or repeated ?column=, all columns by default
+    columns = [
+        column
+        for value in args.getlist("columns")
+        for column in value.split(",")
+        if column
+    ] + args.getlist("column")
+    unknown = [column for column in columns if column not in backend.columns]
+    if unknown:
+        raise BadRequest(f"Unknown columns: {', '.join(unknown)}")
+    return columns or list(backend.columns)
+
+
+max_batch_size = 100
+
+
+def parse_top_n(top_n):
+    if not isinstance(top_n, int) or not 0 < top_n <= 100:
+        raise BadRequest("top_n must be an integer from 1 to 100")
+    return top_n
+
+
+# ?comparison= of a GET request: a key of cache.comparison_modes, or none
+def request_comparison(args):
+    comparison = args.get("comparison") or None
+    if comparison is not None and comparison not in comparison_modes:
+        raise BadRequest(
+            f"comparison must be one of {', '.join(comparison_modes)} or empty"
+        )
+    return comparison
+
+
+# ?top_n= of a GET request, 5 if missing. Anything but an integer is a bad request
+# rather than the default.
+def request_top_n(args):
+    value = args.get("top_n", "5")
+    if not value.isdecimal():
+        raise BadRequest("top_n must be an integer from 1 to 100")
+    return parse_top_n(int(value))
+
+
+# Filter states and top_n of a batch query body, see the /query route
+def parse_batch(backend, body):
+    if not isinstance(body, dict) or not isinstance(body.get("queries"), list):
+        raise BadRequest('Expected a JSON object with a "queries" list')
+    specs = body["queries"]
+    if not 0 < len(specs) <= max_batch_size:
+        raise BadRequest(f"Expected 1 to {max_batch_size} queries")
+    top_n = parse_top_n(body.get("top_n", 5))
+    if not all(isinstance(spec, dict) for spec in specs):
+        raise BadRequest("Every query must be a JSON object")
+
+    filter_states = [
+        parse_filters(
+            backend,
+            spec.get("start_date"),
+            spec.get("end_date"),
+            spec.get("countries") or [],
+            spec.get("categories") or [],
+        )
+        for spec in specs
+    ]
+    return filter_states, top_n
+
+
+########################################################################################
+#################################### Export streams ####################################
+########################################################################################
+
+
+def csv_stream(chunks):
+    header = True
+    for chunk in chunks:
+        yield chunk.to_csv(index=False, header=header)
+        header = False
+
+
+# The Arrow schema of export chunks with these columns, from the fixed dtypes of the
+# merged columns rather than inferred from each response's rows
+def arrow_schema(pa, columns):
+    # Deferred imports, see lazy startup in app.py
+    import numpy as np
+
+    from backends import merged_dtypes
+
+    return pa.schema(
+        [
+            (
+                column,
+                (
+                    pa.string()
+                    if merged_dtypes[column] == "object"
+                    else pa.from_numpy_dtype(np.dtype(merged_dtypes[column]))
+                ),
+            )
+            for column in columns
+        ]
+    )
+
+
+def arrow_stream(chunks):
+    # pyarrow is optional, the route checks that it is installed
+    import pyarrow as pa
+
+    sink = io.BytesIO()
+    writer = None
+    for chunk in chunks:
+        if writer is None:
+            schema = arrow_schema(pa, chunk.columns)
+            writer = pa.ipc.new_stream(sink, schema)
+        writer.write_batch(
+            pa.RecordBatch.from_pandas(chunk, schema=schema, preserve_index=False)
+        )
+        yield sink.getvalue()
+        sink.seek(0)
+        sink.truncate()
+    writer.close()
+    yield sink.getvalue()
+
+
+export_formats = {
+    "csv": (csv_stream, "text/csv", "csv"),
+    "arrow": (arrow_stream, "application/vnd.apache.arrow.stream", "arrows"),
+}
+
+
+########################################################################################
+##################################### Query results ####################################
+########################################################################################
+
+
+def json_number(value):
+    # JSON has no NaN, e.g. the average shipping cost of an empty selection
+    value = float(value)
+    return None if math.isnan(value) else value
+
+
+def series_to_json(time_series):
+    return {
+        "periods": time_series["Period"].tolist(),
+        "sales": time_series["Sales"].tolist(),
+        "profit": time_series["Profit"].tolist(),
+        "shipping_cost": time_series["Shipping.Cost"].tolist(),
+    }
+
+
+def kpis_to_json(kpis):
+    return {name: json_number(value) for name, value in kpis.items()}
+
+
+def aggregates_to_json(filters, aggregates):
+    start_date, end_date, countries, categories = filters
+    top_products = aggregates["top_products"]
+    prior = aggregates["prior"]
+    return {
+        "filters": {
+            "start_date": start_date,
+            "end_date": end_date,
+            "countries": list(countries),
+            "categories": list(categories),
+        },
+        "kpis": kpis_to_json(aggregates["kpis"]),
+        "time_series": {
+            "period": aggregates["period"],
+            **series_to_json(aggregates["time_series"]),
+        },
+        "top_products": [
+            {"product": product, "sales": json_number(sales)}
+            for product, sales in zip(
+                top_products["Product Name"], top_products["Sales"]
+            )
+        ],
+        # The prior window of a comparison mode, its periods moved onto the current
+        # window like on the dashboard
+        "prior": prior
+        and {
+            "label": prior["label"],
+            "kpis": kpis_to_json(prior["kpis"]),
+            "time_series": {
+                **series_to_json(prior["time_series"]),
+                "prior_periods": prior["time_series"]["Prior.Period"].tolist(),
+            },
+        },
+    }
+
+
+# The data of the dashboard's other charts, see graphs.dashboard_graph_builders
+def charts_to_json(backend, filters):
+    category_shares = backend.category_shares(filters)
+    customers = backend.customers_per_country(filters)
+    shipping_modes = backend.shipping_modes(filters)
+    return {
+        "category_shares": [
+            {"category": category, "sales": json_number(sales)}
+            for category, sales in zip(
+                category_shares["Category"], category_shares["Sales"]
+            )
+        ],
+        "customers_per_country": [
+            {"country": country, "customers": int(count)}
+            for country, count in zip(customers["Country"], customers["Customer Count"])
+        ],
+        "shipping_modes": [
+            {
+                "ship_mode": mode,
+                "orders": int(orders),
+                "shipping_cost": json_number(cost),
+            }
+            for mode, orders, cost in zip(
+                shipping_modes["Ship.Mode"],
+                shipping_modes["Orders_per_Mode"],
+                shipping_modes["Shipping_Cost_per_Mode"],
+            )
+        ],
+    }
+
+
+########################################################################################
+##################################### HTTP caching #####################################
+########################################################################################
+
+# Seconds browsers and proxies may reuse a GET response before revalidating it with
+# its ETag. A response only depends on the canonical request and the data version, so
+# revalidating is answered with a 304 before computing anything.
+max_age = int(os.environ.get("DASHBOARD_HTTP_MAX_AGE", 60))
+
+
+# Fingerprint of the code the responses come from, so a deploy that changes them also
+# changes their ETags. Computed once, on first use: the modules are imported lazily.
+@lru_cache(maxsize=None)
+def code_fingerprint():
+    import analytics
+    import backends
+    import graphs
+
+    return source_fingerprint(analytics, backends, graphs, sys.modules[__name__])
+
+
+# Fingerprint of a response: the route, the data version of the dataset, the code
+# fingerprint and the canonical request (filter_key states, columns, ...). None for a
+# backend without a version, whose responses are not cached.
+def response_etag(backend, route, *request_parts):
+    if backend.version is None:
+        return None
+    parts = [route, backend.version, code_fingerprint(), *request_parts]
+    return hashlib.sha1(json.dumps(parts).encode()).hexdigest()[:20]
+
+
+# The response of `build()`, or a 304 without calling it if the client already has the
+# response with this ETag
+def cached_response(etag, build):
+    if etag is not None and request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    else:
+        response = build()
+    if etag is not None:
+        response.set_etag(etag)
+        response.cache_control.public = True
+        response.cache_control.max_age = max_age
+    return response
+
+
+########################################################################################
+####################################### Routes #########################################
+########################################################################################
+
+
+# HTTP routes next to the dashboard; `load_backend(name)` returns the query backend of
+# a dataset, the default one for None. Requests pick it with ?dataset=<name>.
+def create_api(load_backend):
+    api = Blueprint("api", __name__, url_prefix="/api")
+
+    @api.errorhandler(BadRequest)
+    def bad_request(error):
+        return jsonify(error=str(error)), 400
+
+    @api.errorhandler(UnknownDataset)
+    def unknown_dataset(error):
+        return jsonify(error=str(error)), 404
+
+    # Stream the rows behind the current dashboard view as CSV or Arrow IPC
+    @api.route("/export")
+    def export():
+        backend = load_backend(request.args.get("dataset"))
+        export_format = request.args.get("format", "csv")
+        if export_format not in export_formats:
+            raise BadRequest(f"Unknown format: {export_format}")
+        if export_format == "arrow" and importlib.util.find_spec("pyarrow") is None:
+            return jsonify(error="Arrow export requires pyarrow"), 501
+
+        filters = request_filters(backend, request.args)
+        columns = request_columns(backend, request.args)
+        stream, mimetype, extension = export_formats[export_format]
+
+        return cached_response(
+            response_etag(backend, "export", filters, columns, export_format),
+            lambda: Response(
+                stream_with_context(stream(backend.export(filters, columns))),
+                mimetype=mimetype,
+                headers={
+                    "Content-Disposition": f"attachment; filename=sales.{extension}"
+                },
+            ),
+        )
+
+    # The data of every chart of the dashboard for the filters of /export, plus
+    # ?top_n= and ?comparison= (the dashboard's comparison mode): KPIs, time series and
+    # top products as in update_dashboard, with the prior window for a comparison, and
+    # the category shares, customers per country and shipping modes
+    @api.route("/dashboard")
+    def dashboard():
+        # Deferred import, see lazy startup in app.py
+        from analytics import compute_aggregates
+
+        backend = load_backend(request.args.get("dataset"))
+        filters = request_filters(backend, request.args)
+        top_n = request_top_n(request.args)
+        comparison = request_comparison(request.args)
+
+        return cached_response(
+            response_etag(backend, "dashboard", filters, top_n, comparison),
+            lambda: jsonify(
+                **aggregates_to_json(
+                    filters, compute_aggregates(backend, filters, top_n, comparison)
+                ),
+                **charts_to_json(backend, filters),
+            ),
+        )
+
+    # KPIs, time series and top products for a batch of filter specs:
+    # {"queries": [{"start_date", "end_date", "countries", "categories"}, ...],
+    #  "top_n": 5}, every key optional. POSTed as the body, or sent URL-encoded in
+    # ?q= to GET a response that browsers and proxies can cache.
+    @api.route("/query", methods=["GET", "POST"])
+    def query():
+        # Deferred import, see lazy startup in app.py
+        from analytics import compute_batch
+
+        backend = load_backend(request.args.get("dataset"))
+        if request.method == "GET":
+            try:
+                body = json.loads(request.args.get("q", ""))
+            except ValueError:
+                raise BadRequest("Expected a JSON object in ?q=") from None
+        else:
+            body = request.get_json(silent=True)
+        filter_states, top_n = parse_batch(backend, body)
+
+        def build():
+            results = compute_batch(backend, filter_states, top_n)
+            return jsonify(
+                results=[
+                    aggregates_to_json(filters, aggregates)
+                    for filters, aggregates in zip(filter_states, results)
+                ]
+            )
+
+        if request.method == "POST":
+            return build()
+        return cached_response(
+            response_etag(backend, "query", filter_states, top_n), build
+        )
+
+    return api
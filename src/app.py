@@ -1,33 +1,160 @@
+import time
+
+import_started = time.perf_counter()
+
+import math
+import os
+import threading
+
 import dash
-from dash import dcc, html, Input, Output
+from dash import ctx, dcc, html, no_update, Input, Output, State
+from dash.exceptions import PreventUpdate
+from urllib.parse import parse_qs
 import dash_bootstrap_components as dbc
 
-from graphs import get_all_graphs
-from data_processing import merged_data
-
-# Get graphs for the initial data
-(
-    sales_over_time_fig,
-    sales_category_fig,
-    sales_subcategory_fig,
-    profit_over_time_fig,
-    customer_heatmap_fig,
-    customer_city_fig,
-    top_products_fig,
-    shipping_mode_fig,
-    shipping_comparison_fig,
-) = get_all_graphs(merged_data)
-
-# Create a list of countries for the dropdown
-country_options = [
-    {"label": country, "value": country} for country in merged_data["Country"].unique()
-]
+from api import create_api
+from cache import (
+    DiskCache,
+    ResultCache,
+    comparison_modes,
+    default_disk_cache,
+    source_fingerprint,
+)
+from datasets import Dataset, DatasetRegistry, UnknownDataset
+from profiling import profile_stage, profiled
 
-# Create a list of categories for the dropdown
-category_options = [
-    {"label": category, "value": category}
-    for category in merged_data["Category"].unique()
-]
+# With DASHBOARD_LAZY_STARTUP=1 the layout is served with placeholder figures and
+# pandas, plotly.express and the data are only loaded on first use (by the preload
+# thread or the first request), so a worker accepts connections right away
+lazy_startup = os.environ.get("DASHBOARD_LAZY_STARTUP") == "1"
+
+# With DASHBOARD_APPROXIMATE_ROWS=n, selections of an estimated n rows or more that are
+# not cached yet are first answered from a stratified sample, with error bounds on the
+# KPI cards, and refined once the exact result is ready
+approximate_rows = os.environ.get("DASHBOARD_APPROXIMATE_ROWS")
+approximate_rows = int(approximate_rows) if approximate_rows else None
+
+# Dashboard sections each dataset's result cache keeps besides its warm-up set (see
+# warm_up_filters), which it always has room for: DASHBOARD_RESULT_CACHE_SIZE
+result_cache_size = int(os.environ.get("DASHBOARD_RESULT_CACHE_SIZE", 512))
+
+# Datasets served by this process, see datasets.DatasetRegistry. Each page picks one
+# with ?dataset=<name>. DASHBOARD_DATASETS_DIR holds the default dataset's CSVs and
+# one subdirectory per further dataset; DASHBOARD_MEMORY_BUDGET_MB bounds the memory
+# of the datasets (data and indexes, not cached results) loaded at once.
+datasets_dir = os.environ.get(
+    "DASHBOARD_DATASETS_DIR", os.path.join(os.path.dirname(__file__), "data")
+)
+memory_budget = os.environ.get("DASHBOARD_MEMORY_BUDGET_MB")
+memory_budget = int(memory_budget) * 2**20 if memory_budget else None
+
+
+def load_dataset(name, source_dir):
+    # Deferred imports, these pull in pandas and plotly.express
+    import analytics
+    import backends
+    import graphs
+    from analytics import compute_section, dashboard_from_json, dashboard_to_json
+    from backends import create_backend
+
+    # Set DASHBOARD_MEMORY_PROFILE=1 to report the memory this takes
+    with profile_stage(f"load dataset {name}"):
+        # Query backend (in-memory pandas or SQLite) with its own indexes
+        backend = create_backend(source_dir=source_dir)
+        options = filter_options(backend)
+        warm_up_keys = list(warm_up_filters(options))
+
+        def compute(section, *filters):
+            return compute_section(backend, section, *filters)
+
+        # Cache of computed dashboard sections, keyed by analytics.section_keys. Sized
+        # so warming it up does not evict the warm-up's own first entries.
+        results = ResultCache(compute, maxsize=len(warm_up_keys) + result_cache_size)
+        # Shared by all workers on this node, DASHBOARD_CACHE_PATH="" disables it
+        disk_cache_path = os.environ.get("DASHBOARD_CACHE_PATH", default_disk_cache)
+        if disk_cache_path and backend.version:
+            results.store = DiskCache(
+                disk_cache_path,
+                namespace=f"{name}:{backend.version}:"
+                + source_fingerprint(analytics, backends, graphs),
+                dumps=dashboard_to_json,
+                loads=dashboard_from_json,
+            )
+
+        dataset = Dataset(
+            name,
+            backend,
+            results,
+            # Stratified sample (backends.SampleBackend) for approximate answers
+            sample=(
+                backend.stratified_sample() if approximate_rows is not None else None
+            ),
+            options=options,
+        )
+    print(f"Loaded dataset {name} ({dataset.memory / 2**20:.1f} MB)")
+    results.warm_up(warm_up_keys)
+    return dataset
+
+
+# Keys to warm a dataset's cache with when it is loaded, from its filter_options: the
+# default view and every single-country and single-category view. They are computed in the background, the
+# worker serves meanwhile.
+def warm_up_filters(options):
+    from analytics import section_keys
+
+    min_date, max_date, country_options, category_options = options
+    yield from section_keys(min_date, max_date, None, None).values()
+    for option in country_options:
+        yield from section_keys(min_date, max_date, [option["value"]], None).values()
+    for option in category_options:
+        yield from section_keys(min_date, max_date, None, [option["value"]]).values()
+
+
+datasets = DatasetRegistry(datasets_dir, load_dataset, memory_budget)
+
+
+def load_backend(name=None):
+    return datasets.get(name).backend
+
+
+def filter_options(backend):
+    # The default view covers the full date range without country or category filters
+    min_date, max_date = backend.date_bounds()
+
+    # Create a list of countries for the dropdown
+    country_options = [
+        {"label": country, "value": country} for country in backend.options("Country")
+    ]
+
+    # Create a list of categories for the dropdown
+    category_options = [
+        {"label": category, "value": category}
+        for category in backend.options("Category")
+    ]
+
+    return min_date, max_date, country_options, category_options
+
+
+# Empty figure shown until the first callback delivers the real one
+placeholder_figure = {
+    "data": [],
+    "layout": {
+        "paper_bgcolor": "rgba(0,0,0,0)",
+        "plot_bgcolor": "rgba(0,0,0,0)",
+        "xaxis": {"visible": False},
+        "yaxis": {"visible": False},
+    },
+}
+placeholder_figures = {
+    figure_id: placeholder_figure
+    for figure_id in [
+        "sales-over-time",
+        "sales-category",
+        "profit-over-time",
+        "customer-heatmap",
+        "shipping-comparison",
+    ]
+}
 
 # Initialize the Dash app with Bootstrap theme
 app = dash.Dash(
@@ -39,479 +166,778 @@ app = dash.Dash(
 )
 app.title = "E-commerce Sales Analytics Dashboard"
 
+
 # Layout
-app.layout = html.Div(
-    children=[
-        # Header Section
-        html.Div(
-            children=[
-                html.H2(
-                    "Welcome Back to your Sales Analytics Dashboard!",
-                    style={"textAlign": "left", "color": "#ffffff", "flex": 1},
-                ),
-                # Profile Icon Placeholder
-                html.I(
-                    className="bi bi-person-circle",
-                    style={"font-size": "50px", "color": "white", "marginLeft": "10px"},
-                ),
-            ],
-            style={
-                "padding": "20px",
-                "backgroundColor": "#151138",
-                "display": "flex",
-                "alignItems": "center",
-            },
-        ),
-        # Date Picker Section
-        dbc.Row(
-            children=[
-                dbc.Col(
-                    html.Div(
-                        children=[
-                            html.P(
-                                "Set custom filters to analyze your sales",
-                                style={
-                                    "color": "lightgrey",
-                                    "fontSize": "20px",
-                                    "marginRight": "20px",
-                                },
-                            ),
-                        ]
+def build_layout(min_date, max_date, country_options, category_options, figures):
+    return html.Div(
+        children=[
+            # ?dataset=<name> of the page and the dataset it selects
+            dcc.Location(id="url", refresh=False),
+            dcc.Store(id="dataset"),
+            # Countries and categories picked on the map and the category pie
+            dcc.Store(id="cross-filter", data={"countries": [], "categories": []}),
+            # Section keys of an approximate answer, for refine_dashboard
+            dcc.Store(id="exact-sections"),
+            # Header Section
+            html.Div(
+                children=[
+                    html.H2(
+                        "Welcome Back to your Sales Analytics Dashboard!",
+                        style={"textAlign": "left", "color": "#ffffff", "flex": 1},
                     ),
-                    width=3,
-                    style={
-                        "padding": "10px",
-                        "display": "flex",
-                        "alignItems": "center",
-                    },
-                ),
-                dbc.Col(
-                    html.Div(
-                        children=[
-                            dcc.DatePickerRange(
-                                id="date-picker-range",
-                                start_date=merged_data["Order.Date"].min().date(),
-                                end_date=merged_data["Order.Date"].max().date(),
-                                display_format="YYYY-MM-DD",
-                                style={"color": "white"},
-                            ),
-                        ]
+                    # Profile Icon Placeholder
+                    html.I(
+                        className="bi bi-person-circle",
+                        style={
+                            "font-size": "50px",
+                            "color": "white",
+                            "marginLeft": "10px",
+                        },
                     ),
-                    width=3,
-                    style={"padding": "10px"},
-                ),
-                dbc.Col(
-                    html.Div(
-                        children=[
-                            dcc.Dropdown(
-                                id="country-dropdown",
-                                options=country_options,
-                                multi=True,
-                                placeholder="Select countries",
-                                style={"color": "black", "width": "100%"},
-                            ),
-                        ]
+                ],
+                style={
+                    "padding": "20px",
+                    "backgroundColor": "#151138",
+                    "display": "flex",
+                    "alignItems": "center",
+                },
+            ),
+            # Date Picker Section
+            dbc.Row(
+                children=[
+                    dbc.Col(
+                        html.Div(
+                            children=[
+                                html.P(
+                                    "Set custom filters to analyze your sales",
+                                    style={
+                                        "color": "lightgrey",
+                                        "fontSize": "20px",
+                                        "marginRight": "20px",
+                                    },
+                                ),
+                            ]
+                        ),
+                        width=3,
+                        style={
+                            "padding": "10px",
+                            "display": "flex",
+                            "alignItems": "center",
+                        },
                     ),
-                    width=3,
-                    style={"padding": "10px"},
-                ),
-                dbc.Col(
-                    html.Div(
-                        children=[
-                            dcc.Dropdown(
-                                id="category-dropdown",
-                                options=category_options,
-                                multi=True,
-                                placeholder="Select Product Category",
-                                style={"color": "black", "width": "100%"},
-                            ),
-                        ]
+                    dbc.Col(
+                        html.Div(
+                            children=[
+                                dcc.DatePickerRange(
+                                    id="date-picker-range",
+                                    start_date=min_date,
+                                    end_date=max_date,
+                                    display_format="YYYY-MM-DD",
+                                    style={"color": "white"},
+                                ),
+                            ]
+                        ),
+                        width=3,
+                        style={"padding": "10px"},
                     ),
-                    width=3,
-                    style={"padding": "10px"},
-                ),
-            ],
-            style={"padding": "10px", "margin": "0"},
-        ),
-        # Main Dashboard Section
-        dbc.Row(
-            children=[
-                # Total Sales Section
-                dbc.Col(
-                    html.Div(
-                        children=[
-                            # First Card: Total Sales
-                            html.Div(
-                                children=[
-                                    html.H5(
-                                        "Total Sales",
-                                        style={"textAlign": "left", "color": "#ffffff"},
-                                    ),
-                                    dbc.Row(
-                                        html.H4(
-                                            id="total-sales",
+                    dbc.Col(
+                        html.Div(
+                            children=[
+                                dcc.Dropdown(
+                                    id="country-dropdown",
+                                    options=country_options,
+                                    multi=True,
+                                    placeholder="Select countries",
+                                    style={"color": "black", "width": "100%"},
+                                ),
+                            ]
+                        ),
+                        width=2,
+                        style={"padding": "10px"},
+                    ),
+                    dbc.Col(
+                        html.Div(
+                            children=[
+                                dcc.Dropdown(
+                                    id="category-dropdown",
+                                    options=category_options,
+                                    multi=True,
+                                    placeholder="Select Product Category",
+                                    style={"color": "black", "width": "100%"},
+                                ),
+                            ]
+                        ),
+                        width=2,
+                        style={"padding": "10px"},
+                    ),
+                    dbc.Col(
+                        html.Div(
+                            children=[
+                                dcc.Dropdown(
+                                    id="comparison-mode",
+                                    options=[
+                                        {"label": label, "value": mode}
+                                        for mode, label in comparison_modes.items()
+                                    ],
+                                    placeholder="Compare with...",
+                                    style={"color": "black", "width": "100%"},
+                                ),
+                            ]
+                        ),
+                        width=2,
+                        style={"padding": "10px"},
+                    ),
+                ],
+                style={"padding": "10px", "margin": "0"},
+            ),
+            # Main Dashboard Section
+            dbc.Row(
+                children=[
+                    # Total Sales Section
+                    dbc.Col(
+                        html.Div(
+                            children=[
+                                # First Card: Total Sales
+                                html.Div(
+                                    children=[
+                                        html.H5(
+                                            "Total Sales",
                                             style={
                                                 "textAlign": "left",
-                                                "color": "#00cb51",
-                                                "fontSize": "50px",
+                                                "color": "#ffffff",
                                             },
+                                        ),
+                                        dbc.Row(
+                                            html.H4(
+                                                id="total-sales",
+                                                style={
+                                                    "textAlign": "left",
+                                                    "color": "#00cb51",
+                                                    "fontSize": "50px",
+                                                },
+                                            )
+                                        ),
+                                        html.H5(
+                                            "Sales Volume",
+                                            style={
+                                                "textAlign": "left",
+                                                "color": "#ffffff",
+                                                "marginTop": "20px",
+                                            },
+                                        ),
+                                        dbc.Row(
+                                            dcc.Graph(
+                                                figure=figures["sales-over-time"],
+                                                id="sales-over-time",
+                                            )
+                                        ),
+                                    ],
+                                    style={
+                                        "padding": "20px",
+                                        "backgroundColor": "#272950",
+                                        "borderRadius": "10px",
+                                        "marginBottom": "10px",
+                                    },
+                                ),
+                                # Second Card: Sales by Category
+                                html.Div(
+                                    children=[
+                                        dbc.Row(
+                                            children=[
+                                                dbc.Col(
+                                                    children=[
+                                                        html.H5(
+                                                            "Sales Distribution Insights",
+                                                            style={
+                                                                "textAlign": "left",
+                                                                "color": "#ffffff",
+                                                                "padding": "20px",
+                                                            },
+                                                        ),
+                                                    ],
+                                                    width=6,
+                                                ),
+                                                dbc.Col(
+                                                    children=[
+                                                        dcc.Graph(
+                                                            figure=figures[
+                                                                "sales-category"
+                                                            ],
+                                                            id="sales-category",
+                                                            style={
+                                                                "width": "140px",
+                                                                "height": "140px",
+                                                            },
+                                                        )
+                                                    ],
+                                                    width=6,
+                                                ),
+                                            ],
                                         )
-                                    ),
-                                    html.H5(
-                                        "Sales Volume",
-                                        style={
-                                            "textAlign": "left",
-                                            "color": "#ffffff",
-                                            "marginTop": "20px",
-                                        },
-                                    ),
-                                    dbc.Row(
-                                        dcc.Graph(
-                                            figure=sales_over_time_fig,
-                                            id="sales-over-time",
-                                        )
-                                    ),
-                                ],
-                                style={
-                                    "padding": "20px",
-                                    "backgroundColor": "#272950",
-                                    "borderRadius": "10px",
-                                    "marginBottom": "10px",
-                                },
-                            ),
-                            # Second Card: Sales by Category
-                            html.Div(
-                                children=[
-                                    dbc.Row(
-                                        children=[
-                                            dbc.Col(
-                                                children=[
-                                                    html.H5(
-                                                        "Sales Distribution Insights",
-                                                        style={
-                                                            "textAlign": "left",
-                                                            "color": "#ffffff",
-                                                            "padding": "20px",
-                                                        },
-                                                    ),
-                                                ],
-                                                width=6,
-                                            ),
-                                            dbc.Col(
-                                                children=[
-                                                    dcc.Graph(
-                                                        figure=sales_category_fig,
-                                                        id="sales-category",
-                                                        style={
-                                                            "width": "140px",
-                                                            "height": "140px",
-                                                        },
-                                                    )
-                                                ],
-                                                width=6,
-                                            ),
-                                        ],
-                                    )
-                                ],
-                                style={
-                                    "backgroundColor": "#272950",
-                                    "borderRadius": "10px",
-                                    "height": "140px",
-                                },
-                            ),
-                        ],
+                                    ],
+                                    style={
+                                        "backgroundColor": "#272950",
+                                        "borderRadius": "10px",
+                                        "height": "140px",
+                                    },
+                                ),
+                            ],
+                        ),
+                        width=3,
                     ),
-                    width=3,
-                ),
-                # Net Profit Section
-                dbc.Col(
-                    html.Div(
-                        children=[
-                            # First Card: Net Profit
-                            html.Div(
-                                children=[
-                                    html.H5(
-                                        "Net Profit",
-                                        style={"textAlign": "left", "color": "#ffffff"},
-                                    ),
-                                    dbc.Row(
-                                        html.H4(
-                                            id="total-profit",
+                    # Net Profit Section
+                    dbc.Col(
+                        html.Div(
+                            children=[
+                                # First Card: Net Profit
+                                html.Div(
+                                    children=[
+                                        html.H5(
+                                            "Net Profit",
                                             style={
                                                 "textAlign": "left",
-                                                "color": "#00cb51",
-                                                "fontSize": "50px",
+                                                "color": "#ffffff",
                                             },
-                                        )
-                                    ),
-                                    html.H5(
-                                        "Profit Margin",
-                                        style={
-                                            "textAlign": "left",
-                                            "color": "#ffffff",
-                                            "marginTop": "20px",
-                                        },
-                                    ),
-                                    dbc.Row(
-                                        html.H4(
-                                            id="profit-margin",
+                                        ),
+                                        dbc.Row(
+                                            html.H4(
+                                                id="total-profit",
+                                                style={
+                                                    "textAlign": "left",
+                                                    "color": "#00cb51",
+                                                    "fontSize": "50px",
+                                                },
+                                            )
+                                        ),
+                                        html.H5(
+                                            "Profit Margin",
                                             style={
                                                 "textAlign": "left",
-                                                "color": "#00cb51",
-                                                "fontSize": "50px",
+                                                "color": "#ffffff",
+                                                "marginTop": "20px",
                                             },
-                                        )
-                                    ),
-                                ],
-                                style={
-                                    "padding": "20px",
-                                    "backgroundColor": "#272950",
-                                    "borderRadius": "10px",
-                                    "marginBottom": "10px",
-                                },
-                            ),
-                            html.Div(
-                                children=[
-                                    html.H5(
-                                        "Profit Over Time",
-                                        style={"textAlign": "left", "color": "#ffffff"},
-                                    ),
-                                    dbc.Row(
-                                        dcc.Graph(
-                                            figure=profit_over_time_fig,
-                                            id="profit-over-time",
-                                        )
-                                    ),
-                                ],
-                                style={
-                                    "padding": "20px",
-                                    "backgroundColor": "#272950",
-                                    "borderRadius": "10px",
-                                },
-                            ),
-                        ],
+                                        ),
+                                        dbc.Row(
+                                            html.H4(
+                                                id="profit-margin",
+                                                style={
+                                                    "textAlign": "left",
+                                                    "color": "#00cb51",
+                                                    "fontSize": "50px",
+                                                },
+                                            )
+                                        ),
+                                    ],
+                                    style={
+                                        "padding": "20px",
+                                        "backgroundColor": "#272950",
+                                        "borderRadius": "10px",
+                                        "marginBottom": "10px",
+                                    },
+                                ),
+                                html.Div(
+                                    children=[
+                                        html.H5(
+                                            "Profit Over Time",
+                                            style={
+                                                "textAlign": "left",
+                                                "color": "#ffffff",
+                                            },
+                                        ),
+                                        dbc.Row(
+                                            dcc.Graph(
+                                                figure=figures["profit-over-time"],
+                                                id="profit-over-time",
+                                            )
+                                        ),
+                                    ],
+                                    style={
+                                        "padding": "20px",
+                                        "backgroundColor": "#272950",
+                                        "borderRadius": "10px",
+                                    },
+                                ),
+                            ],
+                        ),
+                        width=3,
                     ),
-                    width=3,
-                ),
-                # Shipping Cost Section
-                dbc.Col(
-                    html.Div(
-                        children=[
-                            # First Card: Shipping Costs
-                            html.Div(
-                                children=[
-                                    html.H5(
-                                        "Total Shipping Cost",
-                                        style={"textAlign": "left", "color": "#ffffff"},
-                                    ),
-                                    dbc.Row(
-                                        html.H4(
-                                            id="total-costs",
+                    # Shipping Cost Section
+                    dbc.Col(
+                        html.Div(
+                            children=[
+                                # First Card: Shipping Costs
+                                html.Div(
+                                    children=[
+                                        html.H5(
+                                            "Total Shipping Cost",
                                             style={
                                                 "textAlign": "left",
-                                                "color": "#fb5a62",
-                                                "fontSize": "50px",
+                                                "color": "#ffffff",
                                             },
-                                        )
-                                    ),
-                                    html.H5(
-                                        "Average Shipping Cost",
-                                        style={
-                                            "textAlign": "left",
-                                            "color": "#ffffff",
-                                            "marginTop": "20px",
-                                        },
-                                    ),
-                                    dbc.Row(
-                                        html.H4(
-                                            id="most-expensive-shipping",
+                                        ),
+                                        dbc.Row(
+                                            html.H4(
+                                                id="total-costs",
+                                                style={
+                                                    "textAlign": "left",
+                                                    "color": "#fb5a62",
+                                                    "fontSize": "50px",
+                                                },
+                                            )
+                                        ),
+                                        html.H5(
+                                            "Average Shipping Cost",
                                             style={
                                                 "textAlign": "left",
-                                                "color": "#fb5a62",
-                                                "fontSize": "50px",
+                                                "color": "#ffffff",
+                                                "marginTop": "20px",
                                             },
-                                        )
-                                    ),
-                                ],
-                                style={
-                                    "padding": "20px",
-                                    "backgroundColor": "#272950",
-                                    "borderRadius": "10px",
-                                    "marginBottom": "10px",
-                                },
-                            ),
-                            html.Div(
-                                children=[
-                                    html.H5(
-                                        "Shipping Mode Information",
-                                        style={"textAlign": "left", "color": "#ffffff"},
-                                    ),
-                                    dbc.Row(
-                                        dcc.Graph(
-                                            figure=shipping_comparison_fig,
-                                            id="shipping-comparison",
-                                        )
-                                    ),
-                                ],
-                                style={
-                                    "padding": "20px",
-                                    "backgroundColor": "#272950",
-                                    "borderRadius": "10px",
-                                },
-                            ),
-                        ],
-                    ),
-                    width=3,
-                ),
-                # Customer Insights Section
-                dbc.Col(
-                    html.Div(
-                        children=[
-                            # First Card: Map
-                            html.Div(
-                                children=[
-                                    html.H5(
-                                        "Customer Insights",
-                                        style={"textAlign": "left", "color": "#ffffff"},
-                                    ),
-                                    dbc.Row(
-                                        dcc.Graph(
-                                            figure=customer_heatmap_fig,
-                                            id="customer-heatmap",
-                                        )
-                                    ),
-                                ],
-                                style={
-                                    "padding": "20px",
-                                    "backgroundColor": "#272950",
-                                    "borderRadius": "10px",
-                                    "marginBottom": "10px",
-                                },
-                            ),
-                            # Second Card: Top Products
-                            html.Div(
-                                children=[
-                                    html.Div(
-                                        children=[
-                                            html.H5(
-                                                "Customers Favorite Products",
+                                        ),
+                                        dbc.Row(
+                                            html.H4(
+                                                id="most-expensive-shipping",
                                                 style={
                                                     "textAlign": "left",
-                                                    "color": "white",
-                                                    "marginBottom": "20px",
+                                                    "color": "#fb5a62",
+                                                    "fontSize": "50px",
                                                 },
-                                            ),
-                                            html.Div(id="top-products-container"),
-                                        ],
-                                    ),
-                                ],
-                                style={
-                                    "padding": "20px",
-                                    "paddingBottom": "26px",
-                                    "backgroundColor": "#272950",
-                                    "borderRadius": "10px",
-                                    "height": "260px",
-                                },
-                            ),
-                        ],
+                                            )
+                                        ),
+                                    ],
+                                    style={
+                                        "padding": "20px",
+                                        "backgroundColor": "#272950",
+                                        "borderRadius": "10px",
+                                        "marginBottom": "10px",
+                                    },
+                                ),
+                                html.Div(
+                                    children=[
+                                        html.H5(
+                                            "Shipping Mode Information",
+                                            style={
+                                                "textAlign": "left",
+                                                "color": "#ffffff",
+                                            },
+                                        ),
+                                        dbc.Row(
+                                            dcc.Graph(
+                                                figure=figures["shipping-comparison"],
+                                                id="shipping-comparison",
+                                            )
+                                        ),
+                                    ],
+                                    style={
+                                        "padding": "20px",
+                                        "backgroundColor": "#272950",
+                                        "borderRadius": "10px",
+                                    },
+                                ),
+                            ],
+                        ),
+                        width=3,
                     ),
-                    width=3,
-                ),
-            ],
-            style={"padding": "10px", "margin": "0px"},
-            className="g-2",
-        ),
+                    # Customer Insights Section
+                    dbc.Col(
+                        html.Div(
+                            children=[
+                                # First Card: Map
+                                html.Div(
+                                    children=[
+                                        html.H5(
+                                            "Customer Insights",
+                                            style={
+                                                "textAlign": "left",
+                                                "color": "#ffffff",
+                                            },
+                                        ),
+                                        dbc.Row(
+                                            dcc.Graph(
+                                                figure=figures["customer-heatmap"],
+                                                id="customer-heatmap",
+                                            )
+                                        ),
+                                    ],
+                                    style={
+                                        "padding": "20px",
+                                        "backgroundColor": "#272950",
+                                        "borderRadius": "10px",
+                                        "marginBottom": "10px",
+                                    },
+                                ),
+                                # Second Card: Top Products
+                                html.Div(
+                                    children=[
+                                        html.Div(
+                                            children=[
+                                                html.H5(
+                                                    "Customers Favorite Products",
+                                                    style={
+                                                        "textAlign": "left",
+                                                        "color": "white",
+                                                        "marginBottom": "20px",
+                                                    },
+                                                ),
+                                                html.Div(id="top-products-container"),
+                                            ],
+                                        ),
+                                    ],
+                                    style={
+                                        "padding": "20px",
+                                        "paddingBottom": "26px",
+                                        "backgroundColor": "#272950",
+                                        "borderRadius": "10px",
+                                        "height": "260px",
+                                    },
+                                ),
+                            ],
+                        ),
+                        width=3,
+                    ),
+                ],
+                style={"padding": "10px", "margin": "0px"},
+                className="g-2",
+            ),
+        ],
+        style={
+            "fontFamily": "Arial, sans-serif",
+            "backgroundColor": "#151138",
+            "padding": "0",
+            "margin": "0",
+            "minHeight": "100vh",
+        },
+    )
+
+
+# The page with the default dataset's filters and figures. The dataset stays local, so
+# the module does not keep it alive once the registry evicts it.
+def default_layout():
+    from analytics import section_keys
+
+    dataset = datasets.get()
+    min_date, max_date, country_options, category_options = dataset.options
+    # Get graphs for the initial data; the first callback is then served from the cache
+    figures = {
+        figure_id: figure
+        for key in section_keys(min_date, max_date, None, None).values()
+        for figure_id, figure in dataset.results.get(key)["figures"].items()
+    }
+    return build_layout(min_date, max_date, country_options, category_options, figures)
+
+
+# The default dataset's filters with placeholder figures, the first page load waits
+# for the dataset if the preload thread has not loaded it yet
+def serve_layout():
+    return build_layout(*datasets.get().options, placeholder_figures)
+
+
+if lazy_startup:
+    # Dash would otherwise call serve_layout right away to validate the callbacks
+    app.validation_layout = build_layout(None, None, [], [], placeholder_figures)
+    app.layout = serve_layout
+else:
+    app.layout = default_layout()
+
+
+# Select the dataset of the page from its URL and reset the filters to its values
+@app.callback(
+    [
+        Output("dataset", "data"),
+        Output("date-picker-range", "start_date"),
+        Output("date-picker-range", "end_date"),
+        Output("country-dropdown", "options"),
+        Output("category-dropdown", "options"),
     ],
-    style={
-        "fontFamily": "Arial, sans-serif",
-        "backgroundColor": "#151138",
-        "padding": "0",
-        "margin": "0",
-        "minHeight": "100vh",
-    },
+    Input("url", "search"),
 )
+def select_dataset(search):
+    name = parse_qs((search or "").lstrip("?")).get("dataset", [None])[0]
+    try:
+        dataset = datasets.get(name)
+    except UnknownDataset:
+        # Fall back to the default dataset
+        dataset = datasets.get()
+    min_date, max_date, country_options, category_options = dataset.options
+    return dataset.name, min_date, max_date, country_options, category_options
+
+
+# The filter dimensions (see analytics.section_dimensions) changed by each callback
+# input. Changing a dropdown also resets the cross-filter on the same column.
+input_dimensions = {
+    "date-picker-range.start_date": {"dates"},
+    "date-picker-range.end_date": {"dates"},
+    "country-dropdown.value": {"countries", "map_countries"},
+    "category-dropdown.value": {"categories", "pie_categories"},
+    "comparison-mode.value": {"comparison"},
+    "customer-heatmap.clickData": {"map_countries"},
+    "customer-heatmap.selectedData": {"map_countries"},
+    "sales-category.clickData": {"pie_categories"},
+    "dataset.data": {
+        "dates",
+        "countries",
+        "categories",
+        "comparison",
+        "map_countries",
+        "pie_categories",
+    },
+}
+
 
+# Clicking a country or category selects it, clicking it again clears the selection
+def toggle_selection(selection, value):
+    return [] if selection == [value] else [value]
 
-# Callback to update sales, profit, and graphs based on the selected date range, countries and categories
+
+def update_cross_filter(cross_filter, triggered, map_click, map_selection, pie_click):
+    countries = cross_filter["countries"]
+    categories = cross_filter["categories"]
+    if triggered & {"country-dropdown.value", "dataset.data"}:
+        countries = []
+    if triggered & {"category-dropdown.value", "dataset.data"}:
+        categories = []
+    if "customer-heatmap.clickData" in triggered and map_click:
+        countries = toggle_selection(countries, map_click["points"][0]["location"])
+    if "customer-heatmap.selectedData" in triggered:
+        # Box or lasso selection on the map, None once it is cleared
+        points = map_selection["points"] if map_selection else []
+        countries = sorted({point["location"] for point in points})
+    if "sales-category.clickData" in triggered and pie_click:
+        categories = toggle_selection(categories, pie_click["points"][0]["label"])
+    return {"countries": countries, "categories": categories}
+
+
+dashboard_outputs = [
+    Output("total-sales", "children"),
+    Output("total-profit", "children"),
+    Output("total-costs", "children"),
+    Output("most-expensive-shipping", "children"),
+    Output("profit-margin", "children"),
+    Output("top-products-container", "children"),
+    Output("sales-over-time", "figure"),
+    Output("sales-category", "figure"),
+    Output("profit-over-time", "figure"),
+    Output("customer-heatmap", "figure"),
+    Output("shipping-comparison", "figure"),
+]
+
+
+# Values for dashboard_outputs from computed sections, no_update for missing ones
+def dashboard_values(sections):
+    figures = {
+        figure_id: figure
+        for section in sections.values()
+        for figure_id, figure in section["figures"].items()
+    }
+
+    summary = sections.get("summary")
+    if summary is None:
+        kpi_values = [no_update] * 6
+    else:
+        kpi_values = [
+            kpi_card(summary, "total_sales", "${:,.0f}"),
+            kpi_card(summary, "total_profit", "${:,.0f}"),
+            kpi_card(summary, "total_costs", "${:,.0f}", higher_is_better=False),
+            kpi_card(summary, "average_shipping", "${:,.2f}", higher_is_better=False),
+            kpi_card(summary, "profit_margin", "{:,.2f}%"),
+            updateTopProductList(summary["top_products"]),
+        ]
+
+    return [
+        *kpi_values,
+        figures.get("sales-over-time", no_update),
+        figures.get("sales-category", no_update),
+        figures.get("profit-over-time", no_update),
+        figures.get("customer-heatmap", no_update),
+        figures.get("shipping-comparison", no_update),
+    ]
+
+
+# Answer from the sample first if the exact sections are not cached in this worker
+# and the selection is large
+def answer_approximately(dataset, keys):
+    if dataset.sample is None or all(key in dataset.results for key in keys.values()):
+        return False
+    # The summary depends on every filter, so it is part of every update
+    return dataset.sample.estimated_rows(keys["summary"][1:5]) >= approximate_rows
+
+
+# Callback to update sales, profit, and graphs based on the selected date range,
+# countries and categories and on the cross-filters from the map and the category pie.
+# Only the sections depending on the changed inputs are recomputed, the other outputs
+# are left as they are.
 @app.callback(
     [
-        Output("total-sales", "children"),
-        Output("total-profit", "children"),
-        Output("total-costs", "children"),
-        Output("most-expensive-shipping", "children"),
-        Output("profit-margin", "children"),
-        Output("top-products-container", "children"),
-        Output("sales-over-time", "figure"),
-        Output("sales-category", "figure"),
-        Output("profit-over-time", "figure"),
-        Output("customer-heatmap", "figure"),
-        Output("shipping-comparison", "figure"),
+        *dashboard_outputs,
+        Output("cross-filter", "data"),
+        Output("exact-sections", "data"),
     ],
     [
         Input("date-picker-range", "start_date"),
         Input("date-picker-range", "end_date"),
         Input("country-dropdown", "value"),
         Input("category-dropdown", "value"),
+        Input("comparison-mode", "value"),
+        Input("customer-heatmap", "clickData"),
+        Input("customer-heatmap", "selectedData"),
+        Input("sales-category", "clickData"),
+        Input("dataset", "data"),
     ],
+    [State("cross-filter", "data")],
 )
-def update_dashboard(start_date, end_date, selected_countries, selected_categories):
-    # Filter the sales data based on the selected date range
-    filtered_data = merged_data[
-        (merged_data["Order.Date"] >= start_date)
-        & (merged_data["Order.Date"] <= end_date)
+@profiled("update_dashboard")
+def update_dashboard(
+    start_date,
+    end_date,
+    selected_countries,
+    selected_categories,
+    comparison,
+    map_click,
+    map_selection,
+    pie_click,
+    dataset_name,
+    cross_filter,
+):
+    dataset = datasets.get(dataset_name)
+    from analytics import section_dimensions, section_keys
+
+    # Everything on the initial call, which has no triggering input
+    triggered = set(ctx.triggered_prop_ids)
+    changed = set().union(*(input_dimensions[prop] for prop in triggered))
+    cross_filter = update_cross_filter(
+        cross_filter or {"countries": [], "categories": []},
+        triggered,
+        map_click,
+        map_selection,
+        pie_click,
+    )
+    keys = {
+        section: key
+        for section, key in section_keys(
+            start_date,
+            end_date,
+            selected_countries,
+            selected_categories,
+            comparison,
+            cross_filter["countries"],
+            cross_filter["categories"],
+        ).items()
+        if not triggered or section_dimensions[section] & changed
+    }
+
+    if answer_approximately(dataset, keys):
+        from analytics import approximate_sections, compute_approximate_section
+
+        # Start on the exact sections right away, refine_dashboard then waits for them
+        dataset.results.warm_up(keys.values())
+        sections = {
+            section: compute_approximate_section(dataset.sample, *keys[section])
+            for section in approximate_sections
+            if section in keys
+        }
+        return (*dashboard_values(sections), cross_filter, list(keys.values()))
+
+    sections = {section: dataset.results.get(key) for section, key in keys.items()}
+    return (*dashboard_values(sections), cross_filter, no_update)
+
+
+# Second half of an approximate answer: replace it with the exact sections
+@app.callback(
+    [
+        Output(output.component_id, output.component_property, allow_duplicate=True)
+        for output in dashboard_outputs
+    ],
+    Input("exact-sections", "data"),
+    [
+        State("date-picker-range", "start_date"),
+        State("date-picker-range", "end_date"),
+        State("country-dropdown", "value"),
+        State("category-dropdown", "value"),
+        State("comparison-mode", "value"),
+        State("cross-filter", "data"),
+        State("dataset", "data"),
+    ],
+    prevent_initial_call=True,
+)
+def refine_dashboard(
+    keys,
+    start_date,
+    end_date,
+    selected_countries,
+    selected_categories,
+    comparison,
+    cross_filter,
+    dataset_name,
+):
+    from analytics import section_keys
+
+    # JSON turned the key tuples into lists
+    keys = [
+        tuple(tuple(part) if isinstance(part, list) else part for part in key)
+        for key in keys
     ]
+    current_keys = section_keys(
+        start_date,
+        end_date,
+        selected_countries,
+        selected_categories,
+        comparison,
+        cross_filter["countries"],
+        cross_filter["categories"],
+    ).values()
+    if not set(keys) <= set(current_keys):
+        # The filters changed meanwhile, update_dashboard already answered for those
+        raise PreventUpdate
+    dataset = datasets.get(dataset_name)
+    return dashboard_values({key[0]: dataset.results.get(key) for key in keys})
 
-    if selected_countries:
-        filtered_data = filtered_data[filtered_data["Country"].isin(selected_countries)]
 
-    if selected_categories:
-        filtered_data = filtered_data[
-            filtered_data["Category"].isin(selected_categories)
-        ]
+# KPI card text: the value, its error bound if it is estimated from the sample and its
+# change against the comparison window
+def kpi_card(summary, name, value_format, higher_is_better=True):
+    kpis = summary["kpis"]
+    text = value_format.format(kpis[name])
+    notes = []
+    errors = summary.get("kpi_errors")
+    if errors is not None:
+        text = f"≈{text}"
+    if errors is not None and not math.isnan(errors[name]):
+        notes.append(
+            html.Span(
+                f" ±{value_format.format(errors[name])}",
+                title="95% confidence interval, the exact value follows",
+                style={"fontSize": "16px", "color": "lightgrey", "marginLeft": "8px"},
+            )
+        )
+    if summary["prior_kpis"] is not None:
+        notes.append(kpi_delta(kpis, summary["prior_kpis"], name, higher_is_better))
+    return [text, *notes] if notes else text
 
-    # Calculate total sales, profit and costs
-    total_sales = filtered_data["Sales"].sum()
-    total_profit = filtered_data["Profit"].sum()
-    total_costs = filtered_data["Shipping.Cost"].sum()
-    average_shipping = filtered_data["Shipping.Cost"].mean()
 
-    # Calculate profit margin
-    if total_sales > 0:
-        profit_margin = (total_profit / total_sales) * 100
+# Change of a KPI against the comparison window, in percent (or in percentage points
+# for the margin)
+def kpi_delta(kpis, prior_kpis, name, higher_is_better=True):
+    current, prior = kpis[name], prior_kpis[name]
+    # Nothing to compare against if the prior window has no sales, e.g. before the
+    # first order
+    if prior_kpis["total_sales"] and name == "profit_margin":
+        change = current - prior
+        delta = f"{change:+,.2f} pp"
+    elif prior_kpis["total_sales"] and prior:
+        change = (current - prior) / abs(prior)
+        delta = f"{change:+,.1%}"
     else:
-        profit_margin = 0
-
-    # Get the top 5 products by sales
-    top_products = (
-        filtered_data.groupby("Product Name")["Sales"].sum().nlargest(5).reset_index()
-    )
-    top_products_list = updateTopProductList(top_products)
-
-    # Get the graphs with the updated data
-    (
-        sales_over_time_fig,
-        sales_category_fig,
-        sales_subcategory_fig,
-        profit_over_time_fig,
-        customer_heatmap_fig,
-        customer_city_fig,
-        top_products_fig,
-        shipping_mode_fig,
-        shipping_comparison_fig,
-    ) = get_all_graphs(filtered_data)
-
-    return (
-        f"${total_sales:,.0f}",
-        f"${total_profit:,.0f}",
-        f"${total_costs:,.0f}",
-        f"${average_shipping:,.2f}",
-        f"{profit_margin:,.2f}%",
-        top_products_list,
-        sales_over_time_fig,
-        sales_category_fig,
-        profit_over_time_fig,
-        customer_heatmap_fig,
-        shipping_comparison_fig,
+        change = float("nan")
+    if math.isnan(change):
+        delta = "n/a"
+        color = "lightgrey"
+    elif change == 0:
+        color = "lightgrey"
+    else:
+        color = "#00cb51" if (change > 0) == higher_is_better else "#fb5a62"
+    return html.Span(
+        f" {delta}",
+        title=f"Prior: {prior:,.2f}",
+        style={"fontSize": "16px", "color": color, "marginLeft": "8px"},
     )
 
 
@@ -569,6 +995,17 @@ def updateTopProductList(top_products):
 
 
 server = app.server
+server.register_blueprint(create_api(load_backend))
+
+
+if lazy_startup:
+    # Load the default dataset in the background, which then warms its cache
+    threading.Thread(target=datasets.get, daemon=True).start()
+
+print(
+    f"Dashboard app ready in {time.perf_counter() - import_started:.2f}s "
+    f"({'lazy' if lazy_startup else 'eager'} startup)"
+)
 
 # Run the app
 if __name__ == "__main__":
@@ -0,0 +1,1319 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+# Filters are the canonical tuples built by cache.filter_key:
+# (start_date, end_date, countries, categories), or None for the whole dataset
+
+
+data_dir = os.path.join(os.path.dirname(__file__), "data")
+
+csv_tables = ["customers", "orders", "sales", "products"]
+
+# Columns of the merged dataset, in data_processing.load_merged_data order
+merged_columns = [
+    "Order.ID",
+    "Customer.ID",
+    "Product.ID",
+    "Order.Date",
+    "Sales",
+    "Profit",
+    "Shipping.Cost",
+    "Ship.Mode",
+    "Product Name",
+    "Category",
+    "Sub-Category",
+    "Customer.Name",
+    "Country",
+    "City",
+]
+# Their pandas dtypes, which every backend's export yields. Any column not listed
+# here is text.
+merged_dtypes = {
+    **{column: "object" for column in merged_columns},
+    "Order.ID": "int64",
+    "Order.Date": "datetime64[ns]",
+    "Sales": "float64",
+    "Profit": "float64",
+    "Shipping.Cost": "float64",
+}
+
+
+# Identifies a version of the source CSVs without reading them, used to key caches
+def dataset_fingerprint(source_dir=data_dir):
+    digest = hashlib.sha1()
+    for table in csv_tables:
+        stat = os.stat(os.path.join(source_dir, f"{table}.csv"))
+        digest.update(f"{table}:{stat.st_size}:{stat.st_mtime_ns};".encode())
+    return digest.hexdigest()[:16]
+
+
+# Aggregate by day if the date range is within a month, by month otherwise
+def time_granularity(date_range):
+    if date_range is not None and (date_range[1] - date_range[0]).days <= 31:
+        return "D", "Day"
+    return "M", "Month"
+
+
+def profit_margin(total_sales, total_profit):
+    if total_sales > 0:
+        return (total_profit / total_sales) * 100
+    return 0
+
+
+# The dashboard's KPIs from the totals of a selection, which every backend computes
+# its own way. `shipping_rows` counts the rows with a known shipping cost, the
+# denominator of the average.
+def kpis_from_totals(total_sales, total_profit, total_costs, shipping_rows):
+    return {
+        "total_sales": total_sales,
+        "total_profit": total_profit,
+        "total_costs": total_costs,
+        "average_shipping": total_costs / shipping_rows if shipping_rows else np.nan,
+        "profit_margin": profit_margin(total_sales, total_profit),
+    }
+
+
+# Rows to sample from strata of the given sizes: the fraction rounded up, but at least
+# two rows (to estimate the variance) or the whole stratum if it is smaller
+def stratum_sample_sizes(sizes, fraction):
+    return np.minimum(sizes, np.maximum(2, np.ceil(sizes * fraction).astype(np.int64)))
+
+
+########################################################################################
+################################## Backend interface ###################################
+########################################################################################
+
+
+class QueryBackend:
+    # Everything the dashboard needs from the data, so the storage can be swapped.
+    # `version` identifies the dataset a backend serves (see dataset_fingerprint),
+    # None if unknown.
+
+    version = None
+    columns = merged_columns
+
+    def date_bounds(self):
+        # (first, last) order date of the whole dataset as datetime.date
+        raise NotImplementedError
+
+    def options(self, column):
+        # Distinct values of a filter column (Country or Category)
+        raise NotImplementedError
+
+    def date_range(self, filters):
+        # (first, last) order date of the filtered rows, None if there are none
+        raise NotImplementedError
+
+    def kpis(self, filters):
+        raise NotImplementedError
+
+    def time_series(self, filters, freq):
+        # Sales, profit and shipping cost per "D" (day) or "M" (month) period
+        raise NotImplementedError
+
+    def category_shares(self, filters, column="Category"):
+        raise NotImplementedError
+
+    def shipping_modes(self, filters):
+        raise NotImplementedError
+
+    def customers_per_country(self, filters):
+        raise NotImplementedError
+
+    def top_products(self, filters, n=5):
+        raise NotImplementedError
+
+    def export(self, filters, columns, chunksize=10_000):
+        # Matching rows as DataFrames of at most `chunksize` rows, at least one chunk
+        raise NotImplementedError
+
+    def compare(self, filters, prior_start, prior_end, freq):
+        # KPIs and time series of the filtered rows in the current window (the filter
+        # dates) and in a prior window, evaluated together. Returns a (current, prior)
+        # pair of {"kpis", "time_series"} dicts.
+        raise NotImplementedError
+
+    def batch(self, filter_states, top_n=5):
+        # KPIs, time series (by the time_granularity of each state's rows) and top
+        # products of many filter states, evaluated together. Returns one
+        # {"kpis", "period", "time_series", "top_products"} dict per state.
+        raise NotImplementedError
+
+    def memory_usage(self):
+        # Approximate bytes held in memory, for the memory budget of datasets.py
+        return 0
+
+    def stratified_sample(self, fraction=0.1):
+        # SampleBackend over a random `fraction` of the rows of every Country x Category
+        # stratum (see stratum_sample_sizes), for approximate answers
+        raise NotImplementedError
+
+
+########################################################################################
+################################### Pandas backend #####################################
+########################################################################################
+
+
+# Columns the dashboard groups by, factorized once when the backend is created
+group_columns = [
+    "Country",
+    "Category",
+    "Sub-Category",
+    "Ship.Mode",
+    "Product Name",
+    "Customer.ID",
+]
+measure_columns = ["Sales", "Profit", "Shipping.Cost"]
+
+# Filter states whose row positions a PandasBackend keeps, and their total size in
+# multiples of selecting every row
+row_cache_size = 32
+row_cache_selections = 4
+
+
+class PandasBackend(QueryBackend):
+    # Queries an in-memory merged DataFrame. The frame is never copied or mutated:
+    # group columns are factorized into integer codes up front, a filter state is
+    # resolved once into row positions, and every aggregate is a single bincount
+    # over those positions.
+
+    def __init__(self, data, version=None):
+        self.data = data
+        self.version = version
+
+        self.codes = {}
+        self.labels = {}
+        for column in group_columns:
+            # Sorted like groupby; missing values get code -1
+            codes, labels = pd.factorize(data[column], sort=True)
+            self.codes[column] = codes.astype(np.int32)
+            self.labels[column] = labels
+        # Sums skip missing values like groupby does
+        self.measures = {
+            column: np.nan_to_num(data[column].to_numpy(dtype=np.float64))
+            for column in measure_columns
+        }
+        # Rows with a known shipping cost, the denominator of the average
+        self.shipping_known = data["Shipping.Cost"].notna().to_numpy(dtype=np.float64)
+        dates = data["Order.Date"].to_numpy(dtype="datetime64[D]")
+        self.days = dates.astype(np.int64)
+        self.months = dates.astype("datetime64[M]").astype(np.int64)
+        # Row positions ordered by date, so a date range is a contiguous slice
+        self.date_order = np.argsort(self.days, kind="stable")
+        self.sorted_days = self.days[self.date_order]
+
+        # Row positions of recent filter states: the dashboard asks several aggregates
+        # for the same filters in a row. Bounded by their total size, which
+        # memory_usage counts, as a selection may hold every row.
+        self.row_cache_bytes = row_cache_selections * self.date_order.nbytes
+        self._rows = OrderedDict()
+        self._rows_bytes = 0
+        self._rows_lock = threading.Lock()
+
+    def rows(self, filters):
+        with self._rows_lock:
+            if filters in self._rows:
+                self._rows.move_to_end(filters)
+                return self._rows[filters]
+        rows = self._select(filters)
+        with self._rows_lock:
+            if filters not in self._rows:
+                self._rows[filters] = rows
+                self._rows_bytes += getattr(rows, "nbytes", 0)
+            while (
+                self._rows_bytes > self.row_cache_bytes
+                or len(self._rows) > row_cache_size
+            ):
+                _, evicted = self._rows.popitem(last=False)
+                self._rows_bytes -= getattr(evicted, "nbytes", 0)
+        return rows
+
+    def _select(self, filters):
+        if filters is None:
+            # A slice indexes the arrays as views, without copying them
+            return slice(None)
+        start_date, end_date, selected_countries, selected_categories = filters
+        rows = self.date_rows(start_date, end_date)
+        for column, selected in [
+            ("Country", selected_countries),
+            ("Category", selected_categories),
+        ]:
+            if selected:
+                selected_codes = self.labels[column].get_indexer(list(selected))
+                rows = rows[
+                    np.isin(
+                        self.codes[column][rows], selected_codes[selected_codes >= 0]
+                    )
+                ]
+        return rows
+
+    def date_rows(self, start_date, end_date):
+        # Rows within the date range as a view of the date index, found by binary
+        # search instead of scanning every row
+        first = np.searchsorted(
+            self.sorted_days, np.datetime64(start_date, "D").astype(np.int64), "left"
+        )
+        last = np.searchsorted(
+            self.sorted_days, np.datetime64(end_date, "D").astype(np.int64), "right"
+        )
+        return self.date_order[first:last]
+
+    def _group(self, column, rows, weights=None):
+        # Per-group row counts and weight sums; rows with a missing key are dropped
+        size = len(self.labels[column]) + 1
+        codes = self.codes[column][rows] + 1
+        counts = np.bincount(codes, minlength=size)[1:]
+        if weights is None:
+            return counts, None
+        return counts, np.bincount(codes, weights[rows], minlength=size)[1:]
+
+    def date_bounds(self):
+        # Ends of the date index, without scanning the dates
+        first, last = self.sorted_days[[0, -1]].astype("datetime64[D]").tolist()
+        return first, last
+
+    def options(self, column):
+        return list(self.data[column].unique())
+
+    def date_range(self, filters):
+        return self._label_date_ranges(*self._selection(filters), 1)[0]
+
+    def kpis(self, filters):
+        return self._label_kpis(*self._selection(filters), 1)[0]
+
+    def time_series(self, filters, freq):
+        return self._label_series(*self._selection(filters), [freq])[0]
+
+    def category_shares(self, filters, column="Category"):
+        counts, sales = self._group(column, self.rows(filters), self.measures["Sales"])
+        present = counts > 0
+        return pd.DataFrame(
+            {column: self.labels[column][present], "Sales": sales[present]}
+        )
+
+    def shipping_modes(self, filters):
+        counts, costs = self._group(
+            "Ship.Mode", self.rows(filters), self.measures["Shipping.Cost"]
+        )
+        present = counts > 0
+        return pd.DataFrame(
+            {
+                "Ship.Mode": self.labels["Ship.Mode"][present],
+                "Orders_per_Mode": counts[present],
+                "Shipping_Cost_per_Mode": costs[present],
+            }
+        )
+
+    def customers_per_country(self, filters):
+        rows = self.rows(filters)
+        countries = self.codes["Country"][rows].astype(np.int64)
+        customers = self.codes["Customer.ID"][rows]
+        known = (countries >= 0) & (customers >= 0)
+        # Distinct (country, customer) pairs, then count them per country
+        pairs = np.unique(
+            countries[known] * len(self.labels["Customer.ID"]) + customers[known]
+        )
+        counts = np.bincount(
+            pairs // len(self.labels["Customer.ID"]),
+            minlength=len(self.labels["Country"]),
+        )
+        present = counts > 0
+        return pd.DataFrame(
+            {
+                "Country": self.labels["Country"][present],
+                "Customer Count": counts[present],
+            }
+        )
+
+    def _largest(self, column, values, counts, n):
+        # Like nlargest on a groupby result: ties keep the sorted group order
+        present = np.flatnonzero(counts > 0)
+        top = present[np.argsort(-values[present], kind="stable")[:n]]
+        return self.labels[column][top], values[top]
+
+    def top_products(self, filters, n=5):
+        return self._label_top_products(*self._selection(filters), 1, n)[0]
+
+    def compare(self, filters, prior_start, prior_end, freq):
+        start_date, end_date, selected_countries, selected_categories = filters
+        windows = [(start_date, end_date), (prior_start, prior_end)]
+        # One selection over the date span covering both windows
+        rows = self.rows(
+            (
+                min(start_date, prior_start),
+                max(end_date, prior_end),
+                selected_countries,
+                selected_categories,
+            )
+        )
+        days = self.days[rows]
+        # Label every row with its window; windows may overlap, e.g. a comparison of
+        # a two-year range with the year before, so rows can appear in both
+        window_rows = []
+        for first, last in windows:
+            first = np.datetime64(first, "D").astype(np.int64)
+            last = np.datetime64(last, "D").astype(np.int64)
+            window_rows.append(rows[(days >= first) & (days <= last)])
+        labels = np.repeat([0, 1], [len(window_rows[0]), len(window_rows[1])])
+        rows = np.concatenate(window_rows)
+
+        kpis = self._label_kpis(labels, rows, 2)
+        time_series = self._label_series(labels, rows, [freq, freq])
+        return tuple(
+            {"kpis": kpis[label], "time_series": time_series[label]} for label in (0, 1)
+        )
+
+    def batch(self, filter_states, top_n=5):
+        count = len(filter_states)
+        starts = np.array([filters[0] for filters in filter_states], "datetime64[D]")
+        ends = np.array([filters[1] for filters in filter_states], "datetime64[D]")
+        # One selection over the date span covering every state, then a mask of the
+        # rows each state keeps, from per-state lookup tables of the allowed country
+        # and category codes (every code if none is selected, missing ones included)
+        rows = self.date_rows(starts.min(), ends.max())
+        allowed = {}
+        for column, position in [("Country", 2), ("Category", 3)]:
+            allowed[column] = np.ones((count, len(self.labels[column]) + 1), bool)
+            for state, filters in enumerate(filter_states):
+                if filters[position]:
+                    codes = self.labels[column].get_indexer(list(filters[position]))
+                    allowed[column][state] = False
+                    allowed[column][state, codes[codes >= 0] + 1] = True
+        days = self.days[rows]
+        countries = self.codes["Country"][rows] + 1
+        categories = self.codes["Category"][rows] + 1
+        # Label every row with each state it matches. The masks are states x rows, so
+        # build them for a bounded number of states at a time.
+        labels, matches = [], []
+        step = max(1, 2**24 // max(len(rows), 1))
+        for first in range(0, count, step):
+            states = slice(first, first + step)
+            mask = (
+                (days >= starts[states, None].astype(np.int64))
+                & (days <= ends[states, None].astype(np.int64))
+                & allowed["Country"][states][:, countries]
+                & allowed["Category"][states][:, categories]
+            )
+            state_labels, positions = np.nonzero(mask)
+            labels.append(state_labels + first)
+            matches.append(positions)
+        labels = np.concatenate(labels)
+        rows = rows[np.concatenate(matches)]
+
+        granularities = [
+            time_granularity(date_range)
+            for date_range in self._label_date_ranges(labels, rows, count)
+        ]
+        kpis = self._label_kpis(labels, rows, count)
+        time_series = self._label_series(
+            labels, rows, [freq for freq, _ in granularities]
+        )
+        top_products = self._label_top_products(labels, rows, count, top_n)
+        return [
+            {
+                "kpis": kpis[state],
+                "period": period,
+                "time_series": time_series[state],
+                "top_products": top_products[state],
+            }
+            for state, (_, period) in enumerate(granularities)
+        ]
+
+    # The aggregates of several selections evaluated together, shared by the queries
+    # of a single filter state and compare and batch: `labels` numbers each selected
+    # row in `rows` with its selection, 0 to count - 1 in ascending order. A row may
+    # appear once per selection it belongs to. Every aggregate is a single bincount
+    # over all selections.
+
+    def _selection(self, filters):
+        rows = self.rows(filters)
+        return np.zeros(len(self.days[rows]), np.intp), rows
+
+    # Rows per label and the position of each label's first row
+    def _label_groups(self, labels, count):
+        row_counts = np.bincount(labels, minlength=count)
+        return row_counts, np.cumsum(row_counts) - row_counts
+
+    def _label_date_ranges(self, labels, rows, count):
+        row_counts, starts = self._label_groups(labels, count)
+        present = np.flatnonzero(row_counts)
+        days = self.days[rows]
+        first = np.full(count, -1, np.int64)
+        last = np.full(count, -1, np.int64)
+        if present.size:
+            first[present] = np.minimum.reduceat(days, starts[present])
+            last[present] = np.maximum.reduceat(days, starts[present])
+        return [
+            (
+                (
+                    pd.Timestamp(first[label].astype("datetime64[D]")),
+                    pd.Timestamp(last[label].astype("datetime64[D]")),
+                )
+                if row_counts[label]
+                else None
+            )
+            for label in range(count)
+        ]
+
+    def _label_kpis(self, labels, rows, count):
+        sums = [
+            np.bincount(labels, self.measures[column][rows], minlength=count)
+            for column in measure_columns
+        ]
+        shipping_rows = np.bincount(labels, self.shipping_known[rows], minlength=count)
+        return [
+            kpis_from_totals(*(totals[label] for totals in sums), shipping_rows[label])
+            for label in range(count)
+        ]
+
+    # Time series of every label by its own "D" or "M" in `freqs`, laid out one after
+    # the other as offsets from each label's first period
+    def _label_series(self, labels, rows, freqs):
+        count = len(freqs)
+        daily = np.array([freq == "D" for freq in freqs], bool)
+        periods = np.where(daily[labels], self.days[rows], self.months[rows])
+        row_counts, starts = self._label_groups(labels, count)
+        present = np.flatnonzero(row_counts)
+        first_periods = np.zeros(count, np.int64)
+        widths = np.zeros(count, np.int64)
+        if present.size:
+            first_periods[present] = np.minimum.reduceat(periods, starts[present])
+            widths[present] = (
+                np.maximum.reduceat(periods, starts[present])
+                - first_periods[present]
+                + 1
+            )
+        offsets = np.cumsum(widths) - widths
+        keys = offsets[labels] + periods - first_periods[labels]
+        period_counts = np.bincount(keys, minlength=widths.sum())
+        period_sums = {
+            column: np.bincount(
+                keys, self.measures[column][rows], minlength=widths.sum()
+            )
+            for column in measure_columns
+        }
+
+        time_series = []
+        for label, freq in enumerate(freqs):
+            window = slice(offsets[label], offsets[label] + widths[label])
+            in_series = np.flatnonzero(period_counts[window])
+            time_series.append(
+                pd.DataFrame(
+                    {
+                        "Period": np.datetime_as_string(
+                            (in_series + first_periods[label]).astype(
+                                f"datetime64[{'D' if freq == 'D' else 'M'}]"
+                            )
+                        ),
+                        **{
+                            column: period_sums[column][window][in_series]
+                            for column in measure_columns
+                        },
+                    }
+                )
+            )
+        return time_series
+
+    def _label_top_products(self, labels, rows, count, n):
+        products = len(self.labels["Product Name"])
+        codes = self.codes["Product Name"][rows]
+        known = codes >= 0
+        keys = labels[known] * products + codes[known]
+        counts = np.bincount(keys, minlength=count * products)
+        sales = np.bincount(
+            keys, self.measures["Sales"][rows][known], minlength=count * products
+        )
+        top_products = []
+        for label in range(count):
+            group = slice(label * products, (label + 1) * products)
+            names, top_sales = self._largest(
+                "Product Name", sales[group], counts[group], n
+            )
+            top_products.append(
+                pd.DataFrame({"Product Name": names, "Sales": top_sales})
+            )
+        return top_products
+
+    def memory_usage(self):
+        arrays = [
+            *self.codes.values(),
+            *self.measures.values(),
+            self.shipping_known,
+            self.days,
+            self.months,
+            self.date_order,
+            self.sorted_days,
+        ]
+        return (
+            int(self.data.memory_usage(deep=True).sum())
+            + sum(array.nbytes for array in arrays)
+            + self.row_cache_bytes
+        )
+
+    def stratified_sample(self, fraction=0.1):
+        strata = (self.codes["Country"].astype(np.int64) + 1) * (
+            len(self.labels["Category"]) + 1
+        ) + (self.codes["Category"] + 1)
+        _, strata, sizes = np.unique(strata, return_inverse=True, return_counts=True)
+        # Shuffle (with a fixed seed, so every worker samples the same rows), group the
+        # rows by stratum and keep the first rows of each
+        order = np.random.default_rng(0).permutation(len(strata))
+        order = order[np.argsort(strata[order], kind="stable")]
+        starts = np.cumsum(sizes) - sizes
+        ranks = np.arange(len(order)) - np.repeat(starts, sizes)
+        sampled = np.sort(
+            order[ranks < stratum_sample_sizes(sizes, fraction)[strata[order]]]
+        )
+        return SampleBackend(
+            self.data.iloc[sampled].reset_index(drop=True),
+            sizes[strata[sampled]],
+            self.version,
+        )
+
+    def export(self, filters, columns, chunksize=10_000):
+        rows = self.rows(filters)
+        all_rows = isinstance(rows, slice)
+        total = len(self.data) if all_rows else len(rows)
+        positions = self.data.columns.get_indexer(columns)
+        # Only one chunk of the selected columns is materialized at a time
+        for start in range(0, max(total, 1), chunksize):
+            chunk_rows = (
+                slice(start, start + chunksize)
+                if all_rows
+                else rows[start : start + chunksize]
+            )
+            yield self.data.iloc[chunk_rows, positions]
+
+
+########################################################################################
+################################### SQLite backend #####################################
+########################################################################################
+
+default_database = os.path.join(data_dir, "analytics.sqlite")
+
+# Indexes for the filter columns and the join keys
+sqlite_indexes = {
+    "orders_date": ("orders", "Order.Date"),
+    "orders_order_id": ("orders", "Order.ID"),
+    "sales_order_id": ("sales", "Order.ID"),
+    "products_product_id": ("products", "Product.ID"),
+    "products_category": ("products", "Category"),
+    "customers_customer_id": ("customers", "Customer.ID"),
+    "customers_country": ("customers", "Country"),
+}
+
+# Same inner joins as data_processing.merge_tables
+merged_view = """
+CREATE VIEW merged AS
+SELECT o."Order.ID", o."Customer.ID", o."Product.ID", o."Order.Date",
+       s."Sales", s."Profit", s."Shipping.Cost", s."Ship.Mode",
+       p."Product Name", p."Category", p."Sub-Category",
+       c."Customer.Name", c."Country", c."City"
+FROM orders o
+JOIN sales s ON s."Order.ID" = o."Order.ID"
+JOIN products p ON p."Product.ID" = o."Product.ID"
+JOIN customers c ON c."Customer.ID" = o."Customer.ID"
+"""
+
+
+# Same joins as data_processing.merge_tables, as (rows left of the join selecting its
+# key, table joined, key, name) for the validation report
+validation_joins = [
+    ('SELECT "Order.ID" FROM orders', "sales", "Order.ID", "orders x sales"),
+    (
+        'SELECT o."Product.ID" FROM orders o '
+        'JOIN sales s ON s."Order.ID" = o."Order.ID"',
+        "products",
+        "Product.ID",
+        "x products",
+    ),
+    (
+        'SELECT o."Customer.ID" FROM orders o '
+        'JOIN sales s ON s."Order.ID" = o."Order.ID" '
+        'JOIN products p ON p."Product.ID" = o."Product.ID"',
+        "customers",
+        "Customer.ID",
+        "x customers",
+    ),
+]
+
+
+# data_processing.profile_table of a table loaded by build_sqlite_database, counted by
+# SQLite. `dtypes` are the pandas dtypes the CSV was read with.
+def sqlite_table_profile(connection, table, dtypes):
+    # NULL counts as one more distinct value, like nunique(dropna=False)
+    counts = ", ".join(
+        f'COUNT(*) - COUNT("{column}"), '
+        f'COUNT(DISTINCT "{column}") + (COUNT(*) > COUNT("{column}"))'
+        for column in dtypes
+    )
+    rows, *stats = connection.execute(
+        f"SELECT COUNT(*), {counts} FROM {table}"
+    ).fetchone()
+    (distinct_rows,) = connection.execute(
+        f"SELECT COUNT(*) FROM (SELECT DISTINCT * FROM {table})"
+    ).fetchone()
+    return {
+        "rows": rows,
+        "duplicate_rows": rows - distinct_rows,
+        "columns": {
+            column: {
+                "dtype": str(dtype),
+                "nulls": nulls,
+                "distinct": distinct,
+                "duplicates": rows - distinct,
+            }
+            for (column, dtype), nulls, distinct in zip(
+                dtypes.items(), stats[::2], stats[1::2]
+            )
+        },
+    }
+
+
+# The report of data_processing.load_merged_data, computed by SQLite on the tables of a
+# database being built so the dataset never has to fit in memory. Runs before the
+# duplicate products are dropped and records what dropping them changes.
+def sqlite_validation_report(connection, version, dtypes):
+    def count(sql):
+        return connection.execute(sql).fetchone()[0]
+
+    def missing(table, column, keys_table):
+        return count(
+            f'SELECT COUNT(*) FROM {table} WHERE "{column}" NOT IN '
+            f'(SELECT "{column}" FROM {keys_table})'
+        )
+
+    tables = {
+        table: sqlite_table_profile(connection, table, dtypes[table])
+        for table in csv_tables
+    }
+
+    def duplicates(table, column):
+        return tables[table]["columns"][column]["duplicates"]
+
+    return {
+        "version": version,
+        "tables": tables,
+        "integrity": {
+            "orders.Customer.ID not in customers": missing(
+                "orders", "Customer.ID", "customers"
+            ),
+            "orders.Product.ID not in products": missing(
+                "orders", "Product.ID", "products"
+            ),
+            "orders.Order.ID not in sales": missing("orders", "Order.ID", "sales"),
+            "sales.Order.ID not in orders": missing("sales", "Order.ID", "orders"),
+            "duplicate customers.Customer.ID": duplicates("customers", "Customer.ID"),
+            "duplicate orders.Order.ID": duplicates("orders", "Order.ID"),
+            "duplicate sales.Order.ID": duplicates("sales", "Order.ID"),
+            "duplicate products.Product.ID": duplicates("products", "Product.ID"),
+        },
+        "joins": [],
+        "sanitize": {
+            "dropped duplicate products.Product.ID": duplicates(
+                "products", "Product.ID"
+            ),
+            # Duplicates that are not exact copies, whose other rows were discarded
+            "conflicting products.Product.ID": count(
+                'SELECT COUNT(*) - COUNT(DISTINCT "Product.ID") '
+                '- (COUNT(*) > COUNT("Product.ID")) '
+                "FROM (SELECT DISTINCT * FROM products)"
+            ),
+        },
+    }
+
+
+# Completes a sqlite_validation_report once the duplicate products are dropped
+def sqlite_join_profiles(connection, report):
+    def count(sql):
+        return connection.execute(sql).fetchone()[0]
+
+    for left, table, key, name in validation_joins:
+        report["joins"].append(
+            {
+                "join": name,
+                "key": key,
+                "left_rows": count(f"SELECT COUNT(*) FROM ({left})"),
+                "right_rows": count(f"SELECT COUNT(*) FROM {table}"),
+                "result_rows": count(
+                    f"SELECT COUNT(*) FROM ({left}) l "
+                    f'JOIN {table} r ON r."{key}" = l."{key}"'
+                ),
+                "left_unmatched": count(
+                    f'SELECT COUNT(*) FROM ({left}) l WHERE l."{key}" NOT IN '
+                    f'(SELECT "{key}" FROM {table})'
+                ),
+                "right_unmatched": count(
+                    f'SELECT COUNT(*) FROM {table} WHERE "{key}" NOT IN '
+                    f'(SELECT "{key}" FROM ({left}))'
+                ),
+            }
+        )
+    report["merged_rows"] = report["joins"][-1]["result_rows"]
+
+
+def build_sqlite_database(path, source_dir=data_dir, chunksize=50_000):
+    # Deferred import, data_processing imports this module
+    from data_processing import write_validation_report
+
+    # Load the CSVs chunk by chunk so the sources never have to fit in memory.
+    # Build into a temporary file and move it in place, so concurrent workers
+    # never see a half-written database.
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    connection = sqlite3.connect(tmp_path)
+    # pandas dtypes of the CSV columns across all chunks, for the validation report
+    dtypes = {}
+    try:
+        for table in csv_tables:
+            source = os.path.join(source_dir, f"{table}.csv")
+            dtypes[table] = {}
+            for chunk in pd.read_csv(source, chunksize=chunksize):
+                for column, dtype in chunk.dtypes.items():
+                    dtypes[table][column] = np.result_type(
+                        dtypes[table].get(column, dtype), dtype
+                    )
+                if table == "orders":
+                    chunk["Order.Date"] = pd.to_datetime(
+                        chunk["Order.Date"]
+                    ).dt.strftime("%Y-%m-%d")
+                chunk.to_sql(table, connection, if_exists="append", index=False)
+
+        for name, (table, column) in sqlite_indexes.items():
+            connection.execute(f'CREATE INDEX idx_{name} ON {table} ("{column}")')
+        report = sqlite_validation_report(
+            connection, dataset_fingerprint(source_dir), dtypes
+        )
+        # Products table has duplicates of Product.ID, keep the first occurrence
+        connection.execute(
+            "DELETE FROM products WHERE rowid NOT IN "
+            '(SELECT MIN(rowid) FROM products GROUP BY "Product.ID")'
+        )
+        sqlite_join_profiles(connection, report)
+        connection.execute(merged_view)
+        connection.execute("ANALYZE")
+        connection.commit()
+    finally:
+        connection.close()
+    os.replace(tmp_path, path)
+    write_validation_report(source_dir, report)
+
+
+def sqlite_database_is_stale(path, source_dir=data_dir):
+    if not os.path.exists(path):
+        return True
+    built_at = os.path.getmtime(path)
+    return any(
+        os.path.getmtime(os.path.join(source_dir, f"{table}.csv")) > built_at
+        for table in csv_tables
+    )
+
+
+def where_clause(filters, dates=True):
+    if filters is None:
+        return "", []
+    start_date, end_date, selected_countries, selected_categories = filters
+    conditions = ['"Order.Date" BETWEEN ? AND ?'] if dates else []
+    params = [start_date, end_date] if dates else []
+    if selected_countries:
+        conditions.append(f'"Country" IN ({", ".join("?" * len(selected_countries))})')
+        params.extend(selected_countries)
+    if selected_categories:
+        conditions.append(
+            f'"Category" IN ({", ".join("?" * len(selected_categories))})'
+        )
+        params.extend(selected_categories)
+    if not conditions:
+        return "", []
+    return "WHERE " + " AND ".join(conditions), params
+
+
+# Aggregates of a group of rows: the totals of kpis_from_totals, and the sums of a time
+# series period
+sqlite_kpi_columns = (
+    'TOTAL("Sales") AS "Sales", TOTAL("Profit") AS "Profit", '
+    'TOTAL("Shipping.Cost") AS "Shipping.Cost", '
+    'COUNT("Shipping.Cost") AS "Shipping.Rows"'
+)
+sqlite_series_columns = (
+    'TOTAL("Sales") AS "Sales", TOTAL("Profit") AS "Profit", '
+    'TOTAL("Shipping.Cost") AS "Shipping.Cost"'
+)
+
+
+# KPIs of every label 0 to count - 1 of a frame of sqlite_kpi_columns grouped by its
+# label `column`, the KPIs of no rows for labels it has no rows of
+def label_kpis(totals, column, count):
+    totals = totals.set_index(column)[
+        ["Sales", "Profit", "Shipping.Cost", "Shipping.Rows"]
+    ]
+    return [
+        kpis_from_totals(
+            *(totals.loc[label] if label in totals.index else (0.0, 0.0, 0.0, 0))
+        )
+        for label in range(count)
+    ]
+
+
+# Rows of every label 0 to count - 1 of a frame with a label `column`, without it
+def label_frames(frame, column, count):
+    groups = dict(tuple(frame.groupby(column)))
+    return [
+        groups.get(label, frame.iloc[:0]).drop(columns=column).reset_index(drop=True)
+        for label in range(count)
+    ]
+
+
+class SQLiteBackend(QueryBackend):
+    # Pushes filters and aggregations down to an indexed SQLite file built from the CSVs
+
+    def __init__(self, path=default_database, source_dir=data_dir):
+        # Deferred import, data_processing imports this module
+        from data_processing import read_validation_report
+
+        self.path = path
+        self.version = dataset_fingerprint(source_dir)
+        # The validation report is written while building, so build again without it
+        if sqlite_database_is_stale(path, source_dir) or (
+            read_validation_report(source_dir, self.version) is None
+        ):
+            build_sqlite_database(path, source_dir)
+        # sqlite3 connections must not be shared between threads
+        self._local = threading.local()
+        self._date_bounds = None
+
+    @property
+    def connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+            self._local.connection = connection
+        return connection
+
+    def query(self, sql, filters=None, params=()):
+        where, where_params = where_clause(filters)
+        return pd.read_sql_query(
+            sql.format(where=where), self.connection, params=[*where_params, *params]
+        )
+
+    def date_bounds(self):
+        # Scans the merged view, so only once: the database of a version is read-only
+        if self._date_bounds is None:
+            first, last = self.connection.execute(
+                'SELECT MIN("Order.Date"), MAX("Order.Date") FROM merged'
+            ).fetchone()
+            self._date_bounds = pd.Timestamp(first).date(), pd.Timestamp(last).date()
+        return self._date_bounds
+
+    def options(self, column):
+        rows = self.connection.execute(
+            f'SELECT DISTINCT "{column}" FROM merged ORDER BY "{column}"'
+        ).fetchall()
+        return [row[0] for row in rows]
+
+    def date_range(self, filters):
+        where, params = where_clause(filters)
+        first, last = self.connection.execute(
+            f'SELECT MIN("Order.Date"), MAX("Order.Date") FROM merged {where}', params
+        ).fetchone()
+        if first is None:
+            return None
+        return pd.Timestamp(first), pd.Timestamp(last)
+
+    def kpis(self, filters):
+        where, params = where_clause(filters)
+        return kpis_from_totals(
+            *self.connection.execute(
+                f"SELECT {sqlite_kpi_columns} FROM merged {where}", params
+            ).fetchone()
+        )
+
+    def time_series(self, filters, freq):
+        length = 10 if freq == "D" else 7
+        return self.query(
+            f'SELECT substr("Order.Date", 1, {length}) AS "Period", '
+            f"{sqlite_series_columns} "
+            'FROM merged {where} GROUP BY "Period" ORDER BY "Period"',
+            filters,
+        )
+
+    def category_shares(self, filters, column="Category"):
+        return self.query(
+            f'SELECT "{column}", TOTAL("Sales") AS "Sales" FROM merged {{where}} '
+            f'GROUP BY "{column}" ORDER BY "{column}"',
+            filters,
+        )
+
+    def shipping_modes(self, filters):
+        return self.query(
+            'SELECT "Ship.Mode", COUNT("Order.ID") AS "Orders_per_Mode", '
+            'TOTAL("Shipping.Cost") AS "Shipping_Cost_per_Mode" '
+            'FROM merged {where} GROUP BY "Ship.Mode" ORDER BY "Ship.Mode"',
+            filters,
+        )
+
+    def customers_per_country(self, filters):
+        return self.query(
+            'SELECT "Country", COUNT(DISTINCT "Customer.ID") AS "Customer Count" '
+            'FROM merged {where} GROUP BY "Country" ORDER BY "Country"',
+            filters,
+        )
+
+    def top_products(self, filters, n=5):
+        return self.query(
+            'SELECT "Product Name", TOTAL("Sales") AS "Sales" FROM merged {where} '
+            'GROUP BY "Product Name" ORDER BY "Sales" DESC, "Product Name" LIMIT ?',
+            filters,
+            [n],
+        )
+
+    def compare(self, filters, prior_start, prior_end, freq):
+        start_date, end_date = filters[:2]
+        where, params = where_clause(filters, dates=False)
+        length = 10 if freq == "D" else 7
+        # Joining the two windows labels every row with its window(s) in one statement
+        windows = (
+            'WITH windows("Window", "First", "Last") AS (VALUES (0, ?, ?), (1, ?, ?)) '
+        )
+        window_params = [start_date, end_date, prior_start, prior_end, *params]
+        window_join = (
+            'FROM merged JOIN windows ON "Order.Date" BETWEEN "First" AND "Last"'
+        )
+        totals = pd.read_sql_query(
+            windows + f'SELECT "Window", {sqlite_kpi_columns} {window_join} {where} '
+            'GROUP BY "Window"',
+            self.connection,
+            params=window_params,
+        )
+        by_time = pd.read_sql_query(
+            windows
+            + f'SELECT "Window", substr("Order.Date", 1, {length}) AS "Period", '
+            f"{sqlite_series_columns} {window_join} {where} "
+            'GROUP BY "Window", "Period" ORDER BY "Window", "Period"',
+            self.connection,
+            params=window_params,
+        )
+
+        kpis = label_kpis(totals, "Window", 2)
+        time_series = label_frames(by_time, "Window", 2)
+        return tuple(
+            {"kpis": kpis[label], "time_series": time_series[label]} for label in (0, 1)
+        )
+
+    def batch(self, filter_states, top_n=5):
+        # Join the rows of the date span covering every state once, labelling each row
+        # with the states it matches, into a temporary table that the aggregates then
+        # read. The states' allowed countries and categories (all of them, missing
+        # values included, if none are selected) are indexed temporary tables too, so
+        # labelling a row is a few index lookups. Temporary tables live in a separate
+        # database of the thread-local connection, the file stays read-only.
+        connection = self.connection
+        connection.execute(
+            'CREATE TEMP TABLE batch_specs ("State" INTEGER PRIMARY KEY, '
+            '"First" TEXT, "Last" TEXT, "Length" INTEGER)'
+        )
+        for column in ["Country", "Category"]:
+            connection.execute(
+                f'CREATE TEMP TABLE "batch_{column}" ("{column}" TEXT, '
+                f'"State" INTEGER, PRIMARY KEY ("{column}", "State"))'
+            )
+        try:
+            connection.executemany(
+                "INSERT INTO batch_specs VALUES (?, ?, ?, 7)",
+                [
+                    (state, filters[0], filters[1])
+                    for state, filters in enumerate(filter_states)
+                ],
+            )
+            for column, table, position in [
+                ("Country", "customers", 2),
+                ("Category", "products", 3),
+            ]:
+                # A set: NULL keys are not deduplicated by the primary key
+                every_value = {
+                    value
+                    for (value,) in connection.execute(
+                        f'SELECT DISTINCT "{column}" FROM {table}'
+                    )
+                } | {None}
+                connection.executemany(
+                    f'INSERT OR IGNORE INTO "batch_{column}" VALUES (?, ?)',
+                    [
+                        (value, state)
+                        for state, filters in enumerate(filter_states)
+                        for value in filters[position] or every_value
+                    ],
+                )
+            connection.execute(
+                'CREATE TEMP TABLE batch_rows AS SELECT specs."State", '
+                '"Order.Date", "Sales", "Profit", "Shipping.Cost", "Product Name" '
+                "FROM merged "
+                'JOIN "batch_Country" countries '
+                'ON countries."Country" IS merged."Country" '
+                'JOIN batch_specs specs ON specs."State" = countries."State" '
+                'AND "Order.Date" BETWEEN "First" AND "Last" '
+                'JOIN "batch_Category" categories '
+                'ON categories."State" = specs."State" '
+                'AND categories."Category" IS merged."Category" '
+                'WHERE "Order.Date" BETWEEN ? AND ?',
+                [
+                    min(filters[0] for filters in filter_states),
+                    max(filters[1] for filters in filter_states),
+                ],
+            )
+
+            totals = pd.read_sql_query(
+                f'SELECT "State", {sqlite_kpi_columns}, '
+                'MIN("Order.Date") AS "First.Date", MAX("Order.Date") AS "Last.Date" '
+                'FROM batch_rows GROUP BY "State"',
+                connection,
+            )
+            dates = totals.set_index("State")
+            granularities = [
+                time_granularity(
+                    (
+                        pd.Timestamp(dates.at[state, "First.Date"]),
+                        pd.Timestamp(dates.at[state, "Last.Date"]),
+                    )
+                    if state in dates.index
+                    else None
+                )
+                for state in range(len(filter_states))
+            ]
+            connection.executemany(
+                'UPDATE batch_specs SET "Length" = 10 WHERE "State" = ?',
+                [
+                    (state,)
+                    for state, (freq, _) in enumerate(granularities)
+                    if freq == "D"
+                ],
+            )
+            by_time = pd.read_sql_query(
+                'SELECT "State", substr("Order.Date", 1, "Length") AS "Period", '
+                f"{sqlite_series_columns} "
+                'FROM batch_rows JOIN batch_specs USING ("State") '
+                'GROUP BY "State", "Period" ORDER BY "State", "Period"',
+                connection,
+            )
+            top_products = pd.read_sql_query(
+                'SELECT "State", "Product Name", "Sales" FROM ('
+                'SELECT "State", "Product Name", TOTAL("Sales") AS "Sales", '
+                'ROW_NUMBER() OVER (PARTITION BY "State" ORDER BY TOTAL("Sales") DESC, '
+                '"Product Name") AS "Rank" FROM batch_rows '
+                'GROUP BY "State", "Product Name") '
+                'WHERE "Rank" <= ? ORDER BY "State", "Rank"',
+                connection,
+                params=[top_n],
+            )
+        finally:
+            for table in [
+                "batch_rows",
+                "batch_Country",
+                "batch_Category",
+                "batch_specs",
+            ]:
+                connection.execute(f'DROP TABLE IF EXISTS temp."{table}"')
+            connection.commit()
+
+        count = len(filter_states)
+        kpis = label_kpis(totals, "State", count)
+        time_series = label_frames(by_time, "State", count)
+        top_products = label_frames(top_products, "State", count)
+        return [
+            {
+                "kpis": kpis[state],
+                "period": period,
+                "time_series": time_series[state],
+                "top_products": top_products[state],
+            }
+            for state, (_, period) in enumerate(granularities)
+        ]
+
+    def stratified_sample(self, fraction=0.1):
+        select = ", ".join(f'"{column}"' for column in self.columns)
+        strata = 'PARTITION BY "Country", "Category"'
+        # Shuffle by a hash of the order ID rather than random(), so every worker
+        # samples the same rows and gives the same approximate answers
+        self.connection.create_function(
+            "sample_order",
+            1,
+            lambda value: zlib.crc32(str(value).encode()),
+            deterministic=True,
+        )
+        sample = pd.read_sql_query(
+            f'SELECT {select}, "Stratum.Size" FROM ('
+            f"SELECT *, ROW_NUMBER() OVER ({strata} ORDER BY "
+            'sample_order("Order.ID"), "Order.ID") AS "Sample.Rank", '
+            f'COUNT(*) OVER ({strata}) AS "Stratum.Size" FROM merged) '
+            # Same sample sizes as stratum_sample_sizes: CAST truncates, so add one
+            # where that dropped a fraction to round up
+            'WHERE "Sample.Rank" <= MIN("Stratum.Size", MAX(2, '
+            'CAST(? * "Stratum.Size" AS INTEGER) '
+            '+ (? * "Stratum.Size" > CAST(? * "Stratum.Size" AS INTEGER))))',
+            self.connection,
+            params=[fraction] * 3,
+        )
+        sample["Order.Date"] = pd.to_datetime(sample["Order.Date"])
+        return SampleBackend(
+            sample[list(self.columns)],
+            sample["Stratum.Size"].to_numpy(),
+            self.version,
+        )
+
+    def export(self, filters, columns, chunksize=10_000):
+        where, params = where_clause(filters)
+        select = ", ".join(f'"{column}"' for column in columns)
+        # The cursor streams the rows, only one chunk is held in memory at a time
+        chunks = pd.read_sql_query(
+            f"SELECT {select} FROM merged {where}",
+            self.connection,
+            params=params,
+            chunksize=chunksize,
+        )
+        # Typed like the pandas backend's rows: dates come back as text, and the
+        # columns of an empty result have no values to infer a type from
+        dtypes = {column: merged_dtypes[column] for column in columns}
+        empty = True
+        for chunk in chunks:
+            empty = False
+            yield chunk.astype(dtypes)
+        if empty:
+            yield pd.DataFrame(columns=columns).astype(dtypes)
+
+
+########################################################################################
+################################### Sample backend #####################################
+########################################################################################
+
+
+class SampleBackend(PandasBackend):
+    # Estimates the aggregates of the whole dataset from a stratified random sample. Each
+    # sampled row stands for N / n rows of its Country x Category stratum (N rows in
+    # the stratum, n of them sampled), so sums and counts are weighted by that factor.
+    # Distinct customers cannot be scaled up, customers_per_country is not supported.
+
+    def __init__(self, sample, stratum_sizes, version=None):
+        super().__init__(sample, version)
+        strata = (self.codes["Country"].astype(np.int64) + 1) * (
+            len(self.labels["Category"]) + 1
+        ) + (self.codes["Category"] + 1)
+        _, self.strata = np.unique(strata, return_inverse=True)
+        self.sample_sizes = np.bincount(self.strata)
+        self.population_sizes = np.zeros(len(self.sample_sizes))
+        self.population_sizes[self.strata] = stratum_sizes
+        self.weights = (self.population_sizes / self.sample_sizes)[self.strata]
+
+        # Unweighted values for the variance, weighted ones for the estimates
+        self.values = self.measures
+        self.measures = {
+            column: values * self.weights for column, values in self.values.items()
+        }
+        self.shipping_values = self.shipping_known
+        self.shipping_known = self.shipping_known * self.weights
+
+    def memory_usage(self):
+        arrays = [*self.values.values(), self.shipping_values, self.weights]
+        return super().memory_usage() + sum(array.nbytes for array in arrays)
+
+    def estimated_rows(self, filters):
+        return self.weights[self.rows(filters)].sum()
+
+    def _total_variance(self, values, rows):
+        # Variance of the estimated total of `values` over the selected rows, summed
+        # over the strata: N^2 (1 - n / N) s^2 / n, with s^2 the sample variance of the
+        # stratum's values (zero outside the selection)
+        selected = np.zeros(len(values))
+        selected[rows] = values[rows]
+        n = self.sample_sizes
+        sums = np.bincount(self.strata, selected, minlength=len(n))
+        squares = np.bincount(self.strata, selected**2, minlength=len(n))
+        spread = np.divide(
+            squares - sums**2 / n, n - 1, out=np.zeros(len(n)), where=n > 1
+        )
+        return np.sum(
+            self.population_sizes**2 * (1 - n / self.population_sizes) * spread / n
+        )
+
+    # Half-widths of the 95% confidence intervals of the KPIs
+    def kpi_errors(self, filters, z=1.96):
+        rows = self.rows(filters)
+        kpis = self.kpis(filters)
+        sales = self.values["Sales"]
+        profit = self.values["Profit"]
+        costs = self.values["Shipping.Cost"]
+
+        def bound(values):
+            return z * np.sqrt(max(self._total_variance(values, rows), 0))
+
+        # Ratios are linearized: the error of y / x is that of the total of
+        # (y - ratio * x) / x
+        shipping_known = self.shipping_known[rows].sum()
+        return {
+            "total_sales": bound(sales),
+            "total_profit": bound(profit),
+            "total_costs": bound(costs),
+            "average_shipping": (
+                bound(
+                    (costs - kpis["average_shipping"] * self.shipping_values)
+                    / shipping_known
+                )
+                if shipping_known
+                else np.nan
+            ),
+            "profit_margin": (
+                100
+                * bound(
+                    (profit - kpis["profit_margin"] / 100 * sales) / kpis["total_sales"]
+                )
+                if kpis["total_sales"] > 0
+                else np.nan
+            ),
+        }
+
+    def shipping_modes(self, filters):
+        rows = self.rows(filters)
+        counts, orders = self._group("Ship.Mode", rows, self.weights)
+        _, costs = self._group("Ship.Mode", rows, self.measures["Shipping.Cost"])
+        present = counts > 0
+        return pd.DataFrame(
+            {
+                "Ship.Mode": self.labels["Ship.Mode"][present],
+                "Orders_per_Mode": orders[present],
+                "Shipping_Cost_per_Mode": costs[present],
+            }
+        )
+
+    def customers_per_country(self, filters):
+        raise NotImplementedError(
+            "Distinct customers cannot be estimated from a sample"
+        )
+
+
+########################################################################################
+################################### Backend factory ####################################
+########################################################################################
+
+
+def create_backend(name=None, source_dir=data_dir):
+    # Select the backend with the DASHBOARD_BACKEND environment variable
+    name = name or os.environ.get("DASHBOARD_BACKEND", "pandas")
+    if name == "pandas":
+        from data_processing import load_merged_data
+
+        return PandasBackend(
+            load_merged_data(source_dir), dataset_fingerprint(source_dir)
+        )
+    if name == "sqlite":
+        if source_dir == data_dir:
+            path = os.environ.get("DASHBOARD_DATABASE", default_database)
+        else:
+            # Other datasets keep their database next to their CSVs
+            path = os.path.join(source_dir, "analytics.sqlite")
+        return SQLiteBackend(path, source_dir)
+    raise ValueError(f"Unknown dashboard backend: {name}")
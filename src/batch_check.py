@@ -0,0 +1,113 @@
+"""Consistency check of the query API's batch evaluation.
+
+Evaluates random filter states on each backend both with compute_batch (the /api/query
+path, every state in one pass) and one at a time with compute_aggregates (the
+dashboard's path), and exits with status 1 if any KPI, time series or top products
+differ between the two.
+
+    python batch_check.py [--backend pandas sqlite] [--states 60] [--seed 0]
+"""
+
+import argparse
+import random
+import sys
+from datetime import timedelta
+
+import numpy as np
+
+from analytics import compute_aggregates, compute_batch
+from backends import create_backend
+from cache import filter_key
+
+########################################################################################
+#################################### Filter states #####################################
+########################################################################################
+
+
+# Random filter states over the backend's dates and options: long and short (daily)
+# ranges, selected countries and categories, a state without rows and a repeated one
+def random_states(backend, count, seed):
+    rng = random.Random(seed)
+    min_date, max_date = backend.date_bounds()
+    countries = backend.options("Country")
+    categories = backend.options("Category")
+    states = []
+    for _ in range(count):
+        start = min_date + timedelta(days=rng.randrange((max_date - min_date).days))
+        length = rng.choice([7, 31, 90, 365, 2000])
+        end = min(start + timedelta(days=rng.randrange(length)), max_date)
+        states.append(
+            filter_key(
+                start.isoformat(),
+                end.isoformat(),
+                rng.sample(countries, rng.choice([0, 0, 1, 2])),
+                rng.sample(categories, rng.choice([0, 0, 1, 2])),
+            )
+        )
+    before = (min_date - timedelta(days=30)).isoformat()
+    states.append(filter_key(before, before, None, None))
+    states.append(states[0])
+    return states
+
+
+########################################################################################
+###################################### Comparison ######################################
+########################################################################################
+
+
+# Differences between two results for the same state, as readable lines
+def differences(batch, single):
+    found = []
+    for name, value in single["kpis"].items():
+        if not np.isclose(batch["kpis"][name], value, equal_nan=True):
+            found.append(f"kpi {name}: {batch['kpis'][name]} != {value}")
+    if batch["period"] != single["period"]:
+        found.append(f"period: {batch['period']} != {single['period']}")
+    for name, key in [("time series", "Period"), ("top products", "Product Name")]:
+        frames = batch[name.replace(" ", "_")], single[name.replace(" ", "_")]
+        if list(frames[0][key]) != list(frames[1][key]):
+            found.append(f"{name}: {list(frames[0][key])} != {list(frames[1][key])}")
+            continue
+        for column in frames[1].columns.drop(key):
+            if not np.allclose(
+                frames[0][column].astype(float), frames[1][column].astype(float)
+            ):
+                found.append(f"{name} {column} differs")
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--backend",
+        nargs="+",
+        choices=["pandas", "sqlite"],
+        default=["pandas", "sqlite"],
+    )
+    parser.add_argument("--states", type=int, default=60)
+    parser.add_argument("--top-n", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    failed = False
+    for name in args.backend:
+        backend = create_backend(name)
+        states = random_states(backend, args.states, args.seed)
+        batch = compute_batch(backend, states, args.top_n)
+        mismatched = 0
+        for filters, result in zip(states, batch):
+            found = differences(
+                result, compute_aggregates(backend, filters, args.top_n)
+            )
+            if found:
+                mismatched += 1
+                print(f"{name} {filters}:")
+                for difference in found:
+                    print(f"    {difference}")
+        print(f"{name}: {mismatched} of {len(states)} states differ")
+        failed |= mismatched > 0
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,268 @@
+import hashlib
+import json
+import os
+import queue
+import sqlite3
+import tempfile
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+########################################################################################
+################################# Canonical filters ####################################
+########################################################################################
+
+
+# Dash may send the same filter state in different shapes (dates with or without a time
+# part, unordered multi-select values, None vs. empty list), so normalize it first
+def filter_key(start_date, end_date, selected_countries, selected_categories):
+    return (
+        str(start_date)[:10],
+        str(end_date)[:10],
+        tuple(sorted(selected_countries)) if selected_countries else (),
+        tuple(sorted(selected_categories)) if selected_categories else (),
+    )
+
+
+# Period-over-period comparisons offered next to the filters, see
+# analytics.comparison_window. The mode is part of the cache key of the sections that
+# show it, see analytics.section_keys.
+comparison_modes = {
+    "previous_period": "Previous period",
+    "previous_year": "Same period last year",
+}
+
+
+########################################################################################
+#################################### Result cache ######################################
+########################################################################################
+
+
+class ResultCache:
+    # Thread-safe LRU memo around `compute(*key)`. Concurrent requests for the same key
+    # (e.g. the warm-up thread and a user) wait for a single computation. An optional
+    # `store` (see DiskCache) is consulted before computing and filled afterwards.
+
+    def __init__(self, compute, maxsize=512, store=None):
+        self.compute = compute
+        self.maxsize = maxsize
+        self.store = store
+        self._results = OrderedDict()
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._warm_up_stopped = False
+
+    def get(self, key):
+        with self._lock:
+            if key in self._results:
+                self._results.move_to_end(key)
+                return self._results[key]
+            event = self._pending.get(key)
+            owner = event is None
+            if owner:
+                event = self._pending[key] = threading.Event()
+
+        if not owner:
+            event.wait()
+            with self._lock:
+                if key in self._results:
+                    return self._results[key]
+            # The owning computation failed, so compute it here and surface the error
+            return self.compute(*key)
+
+        try:
+            result = self.store.get(key) if self.store is not None else None
+            if result is None:
+                result = self.compute(*key)
+                if self.store is not None:
+                    self.store.set(key, result)
+            with self._lock:
+                self._results[key] = result
+                if len(self._results) > self.maxsize:
+                    self._results.popitem(last=False)
+            return result
+        finally:
+            with self._lock:
+                del self._pending[key]
+            event.set()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._results
+
+    def __len__(self):
+        with self._lock:
+            return len(self._results)
+
+    # Compute the given keys in the background so the server can accept traffic meanwhile
+    def warm_up(self, keys):
+        _start_warm_up_threads()
+        _warm_up_queue.put((self, keys))
+
+    # Skip the keys not warmed up yet, e.g. once the dataset behind it is evicted so the
+    # queued warm-ups no longer keep it in memory
+    def stop_warm_up(self):
+        self._warm_up_stopped = True
+
+
+# Warm-ups of every ResultCache are queued for a fixed number of daemon threads, so
+# warming up on many requests at once does not start a thread per request
+warm_up_threads = 2
+_warm_up_queue = queue.Queue()
+_warm_up_started = False
+_warm_up_lock = threading.Lock()
+
+
+def _start_warm_up_threads():
+    global _warm_up_started
+    with _warm_up_lock:
+        if _warm_up_started:
+            return
+        _warm_up_started = True
+    for _ in range(warm_up_threads):
+        threading.Thread(target=_warm_up, name="cache-warm-up", daemon=True).start()
+
+
+def _warm_up():
+    while True:
+        results, keys = _warm_up_queue.get()
+        try:
+            for key in keys:
+                if results._warm_up_stopped:
+                    break
+                try:
+                    results.get(key)
+                except Exception as error:
+                    print(f"Cache warm-up failed for {key}: {error}")
+        finally:
+            # Not kept alive while waiting for the next warm-up
+            del results, keys
+            _warm_up_queue.task_done()
+
+
+# Block until every queued warm-up is done, e.g. before measuring a settled process
+def wait_for_warm_up():
+    _warm_up_queue.join()
+
+
+########################################################################################
+##################################### Disk cache #######################################
+########################################################################################
+
+default_disk_cache = os.path.join(tempfile.gettempdir(), "dashboard-cache.sqlite")
+
+
+# Identifies the code that computes and serializes cached results. Part of the disk
+# cache namespace next to the data version, so a deploy does not serve entries in the
+# format or with the figures of the previous code.
+def source_fingerprint(*modules):
+    digest = hashlib.sha1()
+    for module in modules:
+        with open(module.__file__, "rb") as file:
+            digest.update(file.read())
+    return digest.hexdigest()[:16]
+
+
+class DiskCache:
+    # Result store in a SQLite file shared by all workers on a node. Entries are keyed by
+    # the dataset and code fingerprints (`namespace`) plus the canonical filter key,
+    # expire after `ttl` seconds and the least recently used ones are evicted above
+    # `max_bytes`. Access times are only written once per `touch_interval` seconds, so
+    # cache hits rarely take the file's write lock.
+
+    def __init__(
+        self,
+        path,
+        namespace,
+        dumps,
+        loads,
+        max_bytes=256 * 1024 * 1024,
+        ttl=24 * 60 * 60,
+        touch_interval=60,
+    ):
+        self.path = path
+        self.namespace = namespace
+        self.dumps = dumps
+        self.loads = loads
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.touch_interval = touch_interval
+        # sqlite3 connections must not be shared between threads
+        self._local = threading.local()
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "key TEXT PRIMARY KEY, value BLOB, size INTEGER, "
+                "created REAL, accessed REAL)"
+            )
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS idx_entries_accessed ON entries (accessed)"
+            )
+
+    @property
+    def connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            # Wait for other workers' write locks instead of failing right away
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self._local.connection = connection
+        return connection
+
+    def _entry_key(self, key):
+        return json.dumps([self.namespace, key])
+
+    def get(self, key):
+        entry_key = self._entry_key(key)
+        now = time.time()
+        try:
+            row = self.connection.execute(
+                "SELECT value, accessed FROM entries WHERE key = ? AND created > ?",
+                (entry_key, now - self.ttl),
+            ).fetchone()
+            if row is None:
+                return None
+            # Least recently used to the minute is precise enough for eviction
+            if now - row[1] > self.touch_interval:
+                with self.connection:
+                    self.connection.execute(
+                        "UPDATE entries SET accessed = ? WHERE key = ?",
+                        (now, entry_key),
+                    )
+        except sqlite3.Error as error:
+            # The cache is an optimization, a locked or broken file must not fail requests
+            print(f"Disk cache read failed: {error}")
+            return None
+        return self.loads(zlib.decompress(row[0]).decode())
+
+    def set(self, key, value):
+        blob = zlib.compress(self.dumps(value).encode())
+        now = time.time()
+        try:
+            with self.connection:
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)",
+                    (self._entry_key(key), blob, len(blob), now, now),
+                )
+                self._evict(now)
+        except sqlite3.Error as error:
+            print(f"Disk cache write failed: {error}")
+
+    def _evict(self, now):
+        # Expired entries are never served, they only count against the budget
+        (total,) = self.connection.execute("SELECT SUM(size) FROM entries").fetchone()
+        if (total or 0) <= self.max_bytes:
+            return
+        self.connection.execute(
+            "DELETE FROM entries WHERE created <= ?", (now - self.ttl,)
+        )
+        # Keep the most recently used entries that fit into 90% of the size budget, so
+        # the next writes do not have to evict again right away
+        self.connection.execute(
+            "DELETE FROM entries WHERE key IN ("
+            "SELECT key FROM (SELECT key, SUM(size) OVER "
+            "(ORDER BY accessed DESC, key) AS running FROM entries) "
+            "WHERE running > ?)",
+            (self.max_bytes * 9 // 10,),
+        )
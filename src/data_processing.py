@@ -1,6 +1,8 @@
-import pandas as pd
+import json
 import os
 
+import pandas as pd
+
 ########################################################################################
 #################################### Load datasets #####################################
 ########################################################################################
@@ -8,54 +10,180 @@ import os
 base_dir = os.path.dirname(__file__)
 data_dir = os.path.join(base_dir, "data")
 
-# Load files
-customers = pd.read_csv(os.path.join(data_dir, "customers.csv"))
-orders = pd.read_csv(os.path.join(data_dir, "orders.csv"))
-sales = pd.read_csv(os.path.join(data_dir, "sales.csv"))
-products = pd.read_csv(os.path.join(data_dir, "products.csv"))
+
+# Load the files of one dataset, every dataset directory has the same four CSVs
+def load_tables(source_dir=data_dir):
+    customers = pd.read_csv(os.path.join(source_dir, "customers.csv"))
+    orders = pd.read_csv(os.path.join(source_dir, "orders.csv"))
+    sales = pd.read_csv(os.path.join(source_dir, "sales.csv"))
+    products = pd.read_csv(os.path.join(source_dir, "products.csv"))
+    return customers, orders, sales, products
 
 
 ########################################################################################
-############################# Analyze & sanitize datasets ##############################
+################################## Validate datasets ###################################
 ########################################################################################
 
+# Written next to the CSVs of a dataset, recomputed when their fingerprint changes
+validation_report_name = "validation.json"
+
+
+# Shape, dtypes, missing and duplicate values of a table, each computed column-wise
+# by pandas instead of looping over the columns
+def profile_table(df):
+    nulls = df.isna().sum()
+    distinct = df.nunique(dropna=False)
+    return {
+        "rows": len(df),
+        "duplicate_rows": int(df.duplicated().sum()),
+        "columns": {
+            column: {
+                "dtype": str(dtype),
+                "nulls": int(nulls[column]),
+                "distinct": int(distinct[column]),
+                "duplicates": len(df) - int(distinct[column]),
+            }
+            for column, dtype in df.dtypes.items()
+        },
+    }
 
-# This is used to get an overview of the data and see whether there are N/A values or duplicates
-def summarize_data(df, name):
-    print(f"--- {name} Summary ---")
-    print("Shape:", df.shape)
-    print("Data Types:\n", df.dtypes)
-    print("Columns:", df.columns.tolist())
-    print("Missing Values:\n", df.isna().sum())
-    print("\nDuplicate Values in Columns:")
-    for col in df.columns:
-        num_duplicates = df[col].duplicated().sum()
-        print(f"{col}: {num_duplicates} duplicate(s)")
-    print("Sample Data:\n", df.head(), "\n")
-    print("-" * 50)
 
+# Keys without a match in the table they reference, and duplicated primary keys
+def integrity_checks(customers, orders, sales, products):
+    def missing(values, keys):
+        return int((~values.isin(keys)).sum())
 
-# Uncomment to see the summary of each dataset
-# summarize_data(customers, "Customers")
-# summarize_data(orders, "Orders")
-# summarize_data(sales, "Sales")
-# summarize_data(products, "Products")
+    return {
+        "orders.Customer.ID not in customers": missing(
+            orders["Customer.ID"], customers["Customer.ID"]
+        ),
+        "orders.Product.ID not in products": missing(
+            orders["Product.ID"], products["Product.ID"]
+        ),
+        "orders.Order.ID not in sales": missing(orders["Order.ID"], sales["Order.ID"]),
+        "sales.Order.ID not in orders": missing(sales["Order.ID"], orders["Order.ID"]),
+        "duplicate customers.Customer.ID": int(
+            customers["Customer.ID"].duplicated().sum()
+        ),
+        "duplicate orders.Order.ID": int(orders["Order.ID"].duplicated().sum()),
+        "duplicate sales.Order.ID": int(sales["Order.ID"].duplicated().sum()),
+        "duplicate products.Product.ID": int(products["Product.ID"].duplicated().sum()),
+    }
 
-# Products table has duplicates of Product.ID, which is the primary key and should be unique
-# Thus only keeping the first occurrence of each Product.ID
-# Remove duplicates, keeping the first occurrence for each Product.ID
-products = products.drop_duplicates(subset="Product.ID", keep="first")
 
-# Format the order date to pd datetime
-orders["Order.Date"] = pd.to_datetime(orders["Order.Date"])
+# Rows of an inner join on `key`: how many it produces and how many rows of either
+# side it drops for lack of a match
+def join_profile(left, right, key, name):
+    matches = left[key].map(right[key].value_counts())
+    return {
+        "join": name,
+        "key": key,
+        "left_rows": len(left),
+        "right_rows": len(right),
+        "result_rows": int(matches.sum()),
+        "left_unmatched": int(matches.isna().sum()),
+        "right_unmatched": int((~right[key].isin(left[key])).sum()),
+    }
+
+
+def read_validation_report(source_dir, version):
+    path = os.path.join(source_dir, validation_report_name)
+    try:
+        with open(path) as file:
+            report = json.load(file)
+    except (OSError, ValueError):
+        return None
+    return report if report.get("version") == version else None
+
+
+def write_validation_report(source_dir, report):
+    path = os.path.join(source_dir, validation_report_name)
+    # Write a temporary file and move it in place, so readers never see half a report
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "w") as file:
+            json.dump(report, file, indent=2)
+        os.replace(tmp_path, path)
+    except OSError as error:
+        print(f"Could not write the validation report to {path}: {error}")
+        return
+    issues = sum(report["integrity"].values())
+    lost = sum(join["left_unmatched"] for join in report["joins"])
+    print(
+        f"Validated {source_dir}: {issues} integrity issue(s), {lost} row(s) dropped "
+        f"by joins, see {path}"
+    )
+
+
+########################################################################################
+################################### Sanitize datasets ##################################
+########################################################################################
+
+
+# `report` collects what sanitizing changed, if given
+def sanitize_tables(customers, orders, sales, products, report=None):
+    # Products table has duplicates of Product.ID, which is the primary key and should be unique
+    # Thus only keeping the first occurrence of each Product.ID
+    # Remove duplicates, keeping the first occurrence for each Product.ID
+    deduplicated = products.drop_duplicates(subset="Product.ID", keep="first")
+    if report is not None:
+        report["sanitize"] = {
+            "dropped duplicate products.Product.ID": len(products) - len(deduplicated),
+            # Duplicates that are not exact copies, whose other rows were discarded
+            "conflicting products.Product.ID": int(
+                products.drop_duplicates()["Product.ID"].duplicated().sum()
+            ),
+        }
+    products = deduplicated
+
+    # Format the order date to pd datetime
+    orders["Order.Date"] = pd.to_datetime(orders["Order.Date"])
+
+    return customers, orders, sales, products
 
 
 ########################################################################################
 ################################### Merge datasets #####################################
 ########################################################################################
 
-merged_data = pd.merge(orders, sales, on="Order.ID")
-merged_data = pd.merge(merged_data, products, on="Product.ID")
-# This merge step drops customers that have not placed any orders yet,
-# since they are not relevant for sales analysis
-merged_data = pd.merge(merged_data, customers, on="Customer.ID")
+
+# `joins` collects a join_profile of every merge, if given
+def merge_tables(customers, orders, sales, products, joins=None):
+    steps = [
+        (sales, "Order.ID", "orders x sales"),
+        (products, "Product.ID", "x products"),
+        # This merge step drops customers that have not placed any orders yet,
+        # since they are not relevant for sales analysis
+        (customers, "Customer.ID", "x customers"),
+    ]
+    merged_data = orders
+    for table, key, name in steps:
+        if joins is not None:
+            joins.append(join_profile(merged_data, table, key, name))
+        merged_data = pd.merge(merged_data, table, on=key)
+    return merged_data
+
+
+# The merged dataset of the CSVs in `source_dir`. Validates the sources first if they
+# changed since the last validation report.
+def load_merged_data(source_dir=data_dir):
+    from backends import dataset_fingerprint
+
+    version = dataset_fingerprint(source_dir)
+    tables = load_tables(source_dir)
+    if read_validation_report(source_dir, version) is not None:
+        return merge_tables(*sanitize_tables(*tables))
+
+    report = {
+        "version": version,
+        "tables": {
+            name: profile_table(table)
+            for name, table in zip(["customers", "orders", "sales", "products"], tables)
+        },
+        "integrity": integrity_checks(*tables),
+        "joins": [],
+    }
+    merged_data = merge_tables(*sanitize_tables(*tables, report), report["joins"])
+    report["merged_rows"] = len(merged_data)
+    write_validation_report(source_dir, report)
+    return merged_data
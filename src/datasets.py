@@ -0,0 +1,124 @@
+import os
+import threading
+from collections import OrderedDict
+
+########################################################################################
+#################################### Dataset sources ###################################
+########################################################################################
+
+default_dataset = "default"
+
+
+# Datasets under `root`: the CSVs directly in it are the "default" dataset and every
+# subdirectory with the same CSVs (e.g. one regional export each) is a dataset named
+# after the subdirectory
+def find_datasets(root):
+    # Deferred import, backends pulls in pandas
+    from backends import csv_tables
+
+    def has_tables(directory):
+        return all(
+            os.path.isfile(os.path.join(directory, f"{table}.csv"))
+            for table in csv_tables
+        )
+
+    sources = {}
+    if has_tables(root):
+        sources[default_dataset] = root
+    for entry in sorted(os.scandir(root), key=lambda entry: entry.name):
+        if entry.is_dir() and has_tables(entry.path):
+            sources[entry.name] = entry.path
+    return sources
+
+
+########################################################################################
+#################################### Dataset registry ##################################
+########################################################################################
+
+
+class UnknownDataset(Exception):
+    pass
+
+
+class Dataset:
+    # One loaded dataset: its query backend (with its own indexes), its own cache of
+    # results and optionally a stratified sample and the dashboard's filter options
+
+    def __init__(self, name, backend, results, sample=None, options=None):
+        self.name = name
+        self.backend = backend
+        self.results = results
+        self.sample = sample
+        self.options = options
+        self.memory = backend.memory_usage() + (
+            sample.memory_usage() if sample is not None else 0
+        )
+
+
+class DatasetRegistry:
+    # Loads datasets by name on first use with `load(name, source_dir)`, which returns a
+    # Dataset. Loaded datasets are kept while their total memory fits `memory_budget`
+    # bytes (None for no limit); beyond that the least recently used ones are dropped
+    # and loaded again when asked for. The dataset just asked for is always kept.
+
+    def __init__(self, root, load, memory_budget=None):
+        self.root = root
+        self.load = load
+        self.memory_budget = memory_budget
+        self._sources = None
+        self._loaded = OrderedDict()
+        # One lock per dataset, so concurrent first requests load it once
+        self._loading = {}
+        self._lock = threading.Lock()
+
+    @property
+    def sources(self):
+        if self._sources is None:
+            self._sources = find_datasets(self.root)
+        return self._sources
+
+    @property
+    def default_name(self):
+        if default_dataset in self.sources or not self.sources:
+            return default_dataset
+        return next(iter(self.sources))
+
+    def get(self, name=None):
+        name = name or self.default_name
+        if name not in self.sources:
+            raise UnknownDataset(f"Unknown dataset: {name}")
+        with self._lock:
+            if name in self._loaded:
+                self._loaded.move_to_end(name)
+                return self._loaded[name]
+            loading = self._loading.setdefault(name, threading.Lock())
+
+        with loading:
+            with self._lock:
+                if name in self._loaded:
+                    self._loaded.move_to_end(name)
+                    return self._loaded[name]
+            dataset = self.load(name, self.sources[name])
+            with self._lock:
+                self._loaded[name] = dataset
+                self._evict()
+        return dataset
+
+    def _evict(self):
+        # The most recently used dataset is last and never evicted
+        while (
+            self.memory_budget is not None
+            and len(self._loaded) > 1
+            and sum(dataset.memory for dataset in self._loaded.values())
+            > self.memory_budget
+        ):
+            name, dataset = self._loaded.popitem(last=False)
+            dataset.results.stop_warm_up()
+            print(
+                f"Evicted dataset {name} ({dataset.memory / 2**20:.1f} MB) to stay "
+                "within the memory budget"
+            )
+
+    def loaded(self):
+        with self._lock:
+            return list(self._loaded)
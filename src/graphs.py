@@ -1,26 +1,43 @@
 import plotly.express as px
-import pandas as pd
+import plotly.graph_objects as go
 
+########################################################################################
+##################################### Sales Graphs #####################################
+########################################################################################
 
-def get_all_graphs(data):
 
-    ########################################################################################
-    ##################################### Sales Graphs #####################################
-    ########################################################################################
+# Overlay the prior window of a period comparison as a dotted line, hovering with the
+# prior period's own dates
+def add_prior_trace(fig, prior, x_column, y_column):
+    if prior is None:
+        return
+    prior_by_time = prior["time_series"]
+    fig.update_traces(name="Selected period", showlegend=True)
+    fig.add_trace(
+        go.Scatter(
+            x=prior_by_time["Period"],
+            y=prior_by_time[y_column],
+            customdata=prior_by_time["Prior.Period"],
+            name=prior["label"],
+            mode="lines",
+            line=dict(dash="dot", color="lightgray"),
+            hovertemplate=f"{x_column}=%{{customdata}}<br>{y_column}=%{{y}}"
+            "<extra></extra>",
+        )
+    )
+    fig.update_layout(
+        legend=dict(
+            title=None,
+            font=dict(size=12, color="white"),
+            orientation="h",
+            yanchor="bottom",
+            y=1.02,
+            xanchor="left",
+        ),
+    )
 
-    # Check the date range to determine aggregation level
-    if (data["Order.Date"].max() - data["Order.Date"].min()).days <= 31:
-        # Aggregate by day if the date range is within a month
-        data = data.copy()
-        data.loc[:, "Day"] = data["Order.Date"].dt.to_period("D").astype(str)
-        sales_by_time = data.groupby("Day").agg({"Sales": "sum"}).reset_index()
-        x_column = "Day"
-    else:
-        # Aggregate by month otherwise
-        data.loc[:, "Month"] = data["Order.Date"].dt.to_period("M").astype(str)
-        sales_by_time = data.groupby("Month").agg({"Sales": "sum"}).reset_index()
-        x_column = "Month"
 
+def build_sales_over_time_fig(sales_by_time, x_column, prior=None):
     # Plot aggregated sales by month
     sales_over_time_fig = px.line(
         sales_by_time,
@@ -46,24 +63,16 @@ def get_all_graphs(data):
         margin=dict(l=10, r=10, t=0, b=10),
         autosize=True,
     )
+    add_prior_trace(sales_over_time_fig, prior, x_column, "Sales")
+    return sales_over_time_fig
 
-    ########################################################################################
-    ##################################### Profit Graphs ####################################
-    ########################################################################################
 
-    # Check the date range to determine aggregation level
-    if (data["Order.Date"].max() - data["Order.Date"].min()).days <= 31:
-        # Aggregate by day if the date range is within a month
-        data = data.copy()
-        data.loc[:, "Day"] = data["Order.Date"].dt.to_period("D").astype(str)
-        profit_by_time = data.groupby("Day").agg({"Profit": "sum"}).reset_index()
-        x_column = "Day"
-    else:
-        # Aggregate by month otherwise
-        data.loc[:, "Month"] = data["Order.Date"].dt.to_period("M").astype(str)
-        profit_by_time = data.groupby("Month").agg({"Profit": "sum"}).reset_index()
-        x_column = "Month"
+########################################################################################
+##################################### Profit Graphs ####################################
+########################################################################################
 
+
+def build_profit_over_time_fig(profit_by_time, x_column, prior=None):
     profit_over_time_fig = px.line(
         profit_by_time,
         x=x_column,
@@ -87,14 +96,19 @@ def get_all_graphs(data):
         font=dict(family="Arial, sans-serif", size=12, color="white"),
         margin=dict(l=10, r=10, t=0, b=10),
     )
+    add_prior_trace(profit_over_time_fig, prior, x_column, "Profit")
+    return profit_over_time_fig
+
+
+########################################################################################
+############################ Sales Distribution Graphs #################################
+########################################################################################
 
-    ########################################################################################
-    ############################ Sales Distribution Graphs #################################
-    ########################################################################################
 
+def build_sales_category_fig(sales_by_category):
     # Sales distribution by category
     sales_category_fig = px.pie(
-        data,
+        sales_by_category,
         names="Category",
         values="Sales",
         color_discrete_sequence=px.colors.sequential.dense,
@@ -108,153 +122,45 @@ def get_all_graphs(data):
     sales_category_fig.update_traces(
         textinfo="percent+label", textposition="inside", textfont=dict(color="black")
     )
+    return sales_category_fig
 
-    # Sales distribution by sub-category
-    sales_subcategory_fig = px.pie(
-        data,
-        names="Sub-Category",
-        values="Sales",
-        title="Sales by Sub-Category",
-    )
-    sales_subcategory_fig.update_traces(textinfo="percent+label")
 
-    ########################################################################################
-    ################################## Shipping Graphs #####################################
-    ########################################################################################
+########################################################################################
+################################## Shipping Graphs #####################################
+########################################################################################
 
-    shipping_costs_by_month = (
-        data.groupby("Month").agg({"Shipping.Cost": "sum"}).reset_index()
-    )
-    shipping_costs_over_time_fig = px.line(
-        shipping_costs_by_month,
-        x="Month",
-        y="Shipping.Cost",
-        title="Shipping Cost Over Time",
-    )
-    shipping_costs_over_time_fig.update_layout(
-        xaxis=dict(
-            title=None,
-            showgrid=False,
-            zeroline=False,
-        ),
-        yaxis=dict(
-            title=None,
-            showgrid=True,
-            gridcolor="lightgray",
-            zeroline=False,
-        ),
-        plot_bgcolor="rgba(0,0,0,0)",
-        paper_bgcolor="rgba(0,0,0,0)",
-        font=dict(family="Arial, sans-serif", size=12, color="white"),
-        margin=dict(l=10, r=10, t=50, b=10),
-    )
-
-    # Most used shipping mode
-    shipping_mode_data = (
-        data["Ship.Mode"]
-        .value_counts(normalize=True)
-        .reset_index()
-        .rename(columns={"Ship.Mode": "Ship Mode", "proportion": "Percentage"})
-        .sort_values("Percentage", ascending=True)
-    )
-    shipping_mode_data["Tick.Labels"] = shipping_mode_data["Ship Mode"].apply(
-        lambda x: x.replace(" ", "<br>")
-    )
-    shipping_mode_fig = px.bar(
-        shipping_mode_data,
-        x="Percentage",
-        y="Ship Mode",
-        orientation="h",
-    )
-    shipping_mode_fig.update_traces(
-        text=shipping_mode_data.apply(lambda row: f"{row['Percentage']:.1%}", axis=1),
-        textposition="inside",
-        textfont=dict(color="white"),
-        marker_color="#656ef2",
-        marker=dict(
-            line=dict(width=0),
-            color="#656ef2",
-            cornerradius=10,
-        ),
-        # width=0.15,  # Make bars thinner
-        hoverinfo="none",
-    )
-    shipping_mode_fig.update_layout(
-        title=dict(
-            text="Most Used Shipping Mode",
-            x=0.5,
-            font=dict(color="white", size=18),
-        ),
-        xaxis=dict(
-            title=None,
-            showgrid=False,
-            showticklabels=False,
-            zeroline=False,
-        ),
-        yaxis=dict(
-            title=None,
-            showticklabels=True,
-            tickvals=list(range(len(shipping_mode_data))),
-            ticktext=shipping_mode_data["Tick.Labels"],
-            showgrid=False,
-            zeroline=False,
-            ticklabelstandoff=10,
-            tickfont=dict(color="white"),
-        ),
-        barmode="stack",
-        bargap=0.5,
-        paper_bgcolor="rgba(0,0,0,0)",
-        plot_bgcolor="rgba(0,0,0,0)",
-        margin=dict(t=40, b=10, l=10, r=30),
-    )
 
+def build_shipping_comparison_fig(shipping_modes):
     # Shipping comparion order share and cost share
-    # Calculate total sales and total shipping costs per shipping mode
-    aggregated_data = (
-        data.groupby("Ship.Mode")
-        .agg(
-            Orders_per_Mode=("Order.ID", "count"),
-            Shipping_Cost_per_Mode=("Shipping.Cost", "sum"),
-        )
-        .reset_index()
-    )
-    # Calculate proportions for sales and shipping costs
-    aggregated_data["Order_Share"] = (
-        aggregated_data["Orders_per_Mode"] / aggregated_data["Orders_per_Mode"].sum()
-    )
-    aggregated_data["Shipping_Cost_Share"] = (
-        aggregated_data["Shipping_Cost_per_Mode"]
-        / aggregated_data["Shipping_Cost_per_Mode"].sum()
-    )
-
-    # Melt data for a grouped bar chart
-    melted_data = pd.melt(
-        aggregated_data,
-        id_vars=["Ship.Mode"],
-        value_vars=["Order_Share", "Shipping_Cost_Share"],
-        var_name="Metric",
-        value_name="Proportion",
-    )
-    melted_data["Tick.Labels"] = melted_data["Ship.Mode"].apply(
-        lambda x: x.replace(" ", "<br />")
-    )
-
-    melted_data["Metric"] = melted_data["Metric"].replace(
-        {
-            "Order_Share": "Share of Orders",
-            "Shipping_Cost_Share": "Share of Shipping Costs",
-        }
-    )
-
-    # Plot the grouped bar chart
-    shipping_comparison_fig = px.bar(
-        melted_data,
-        x="Ship.Mode",
-        y="Proportion",
-        color="Metric",
-        barmode="group",
-        text=melted_data["Proportion"].apply(lambda x: f"{x:.1%}"),
+    # One bar per shipping mode for each share, side by side
+    ship_modes = shipping_modes["Ship.Mode"]
+    shipping_comparison_fig = go.Figure(
+        [
+            go.Bar(
+                name=name,
+                x=ship_modes,
+                y=values / values.sum(),
+                # Formatted by plotly.js in the browser
+                texttemplate="%{y:.1%}",
+                marker_color=color,
+                hovertemplate=f"Metric={name}<br>Ship.Mode=%{{x}}<br>"
+                "Proportion=%{y}<extra></extra>",
+            )
+            for name, values, color in [
+                (
+                    "Share of Orders",
+                    shipping_modes["Orders_per_Mode"],
+                    px.colors.qualitative.Plotly[0],
+                ),
+                (
+                    "Share of Shipping Costs",
+                    shipping_modes["Shipping_Cost_per_Mode"],
+                    px.colors.qualitative.Plotly[1],
+                ),
+            ]
+        ]
     )
+    shipping_comparison_fig.update_layout(barmode="group")
 
     # Customize the layout
     shipping_comparison_fig.update_traces(
@@ -264,8 +170,8 @@ def get_all_graphs(data):
     )
 
     # workaround to get a linebreak to the ticktext
-    tick_vals = melted_data["Ship.Mode"].unique()
-    tick_text = [label.replace(" ", "<br>") for label in tick_vals]
+    tick_vals = ship_modes
+    tick_text = ship_modes.str.replace(" ", "<br>", regex=False)
 
     shipping_comparison_fig.update_layout(
         title=None,
@@ -295,18 +201,16 @@ def get_all_graphs(data):
         plot_bgcolor="rgba(0,0,0,0)",
         margin=dict(t=0, b=0, l=10, r=10),
     )
+    return shipping_comparison_fig
 
-    ########################################################################################
-    ################################## Customer Graphs #####################################
-    ########################################################################################
 
-    # Customers per country
-    customers_per_country = (
-        data.groupby("Country")["Customer.ID"]
-        .nunique()
-        .reset_index(name="Customer Count")
-    )
+########################################################################################
+################################## Customer Graphs #####################################
+########################################################################################
+
 
+def build_customer_heatmap_fig(customers_per_country):
+    # Customers per country
     customer_heatmap_fig = px.choropleth(
         customers_per_country,
         locations="Country",
@@ -341,43 +245,36 @@ def get_all_graphs(data):
         plot_bgcolor="rgba(0,0,0,0)",
         margin={"r": 0, "t": 0, "l": 0, "b": 0},
     )
+    return customer_heatmap_fig
 
-    # Top cities by customer count
-    customers_per_city = data.groupby("City").size().reset_index(name="Customer Count")
-    top_cities = customers_per_city.nlargest(10, "Customer Count")
 
-    customers_city_fig = px.bar(
-        top_cities,
-        x="City",
-        y="Customer Count",
-        title="Top 10 Cities by Number of Customers",
-        text="Customer Count",
-    )
-    customers_city_fig.update_layout(xaxis_title="City", yaxis_title="Customer Count")
+########################################################################################
+##################################### All Graphs #######################################
+########################################################################################
 
-    ########################################################################################
-    ################################### Product Graphs #####################################
-    ########################################################################################
 
-    # Top 10 products by sales
-    top_products_fig = px.bar(
-        data.groupby("Product Name")["Sales"].sum().nlargest(10).reset_index(),
-        x="Sales",
-        y="Product Name",
-        orientation="h",
-        labels={"Sales": "Sales", "Product Name": "Product"},
-        title="Top 10 Products by Sales",
-    )
-    top_products_fig.update_layout(yaxis={"categoryorder": "total ascending"})
+# The time series figures shown on the dashboard, from analytics.compute_aggregates
+def get_time_series_graphs(aggregates):
+    x_column = aggregates["period"]
+    by_time = aggregates["time_series"].rename(columns={"Period": x_column})
+    prior = aggregates["prior"]
 
-    return (
-        sales_over_time_fig,
-        sales_category_fig,
-        sales_subcategory_fig,
-        profit_over_time_fig,
-        customer_heatmap_fig,
-        customers_city_fig,
-        top_products_fig,
-        shipping_mode_fig,
-        shipping_comparison_fig,
-    )
+    return {
+        "sales-over-time": build_sales_over_time_fig(by_time, x_column, prior),
+        "profit-over-time": build_profit_over_time_fig(by_time, x_column, prior),
+    }
+
+
+# The other dashboard figures by graph id, each from its own backend aggregate so it can
+# be rebuilt on its own when cross-filtering
+dashboard_graph_builders = {
+    "sales-category": lambda backend, filters: build_sales_category_fig(
+        backend.category_shares(filters)
+    ),
+    "customer-heatmap": lambda backend, filters: build_customer_heatmap_fig(
+        backend.customers_per_country(filters)
+    ),
+    "shipping-comparison": lambda backend, filters: build_shipping_comparison_fig(
+        backend.shipping_modes(filters)
+    ),
+}
@@ -0,0 +1,341 @@
+"""Concurrent-user load test for the update_dashboard callback.
+
+Starts the app under gunicorn (or targets a running server with --url), replays
+realistic filter-change sessions as POSTs to /_dash-update-component from many
+virtual users and reports latency percentiles, throughput and response sizes.
+
+    python loadtest.py --workers 4 --users 16 --duration 60
+"""
+
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import defaultdict
+from datetime import date, timedelta
+
+base_dir = os.path.dirname(os.path.abspath(__file__))
+
+
+########################################################################################
+#################################### Server setup ######################################
+########################################################################################
+
+
+def start_server(port, workers, threads, env):
+    command = [
+        sys.executable,
+        "-m",
+        "gunicorn",
+        "--chdir",
+        base_dir,
+        "--bind",
+        f"127.0.0.1:{port}",
+        "--workers",
+        str(workers),
+        "--threads",
+        str(threads),
+        "--log-level",
+        "warning",
+        "app:server",
+    ]
+    return subprocess.Popen(command, env={**os.environ, **env})
+
+
+def wait_until_ready(url, timeout=120):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with urllib.request.urlopen(f"{url}/_dash-layout", timeout=5) as response:
+                return json.load(response)
+        except (urllib.error.URLError, ConnectionError):
+            time.sleep(0.25)
+    raise RuntimeError(f"Server at {url} not ready after {timeout}s")
+
+
+def fetch_json(url):
+    with urllib.request.urlopen(url, timeout=30) as response:
+        return json.load(response)
+
+
+# Walk the layout JSON to find the props of a component by id
+def find_component(node, component_id):
+    if isinstance(node, dict):
+        props = node.get("props", {})
+        if props.get("id") == component_id:
+            return props
+        node = props.get("children")
+    if isinstance(node, list):
+        for child in node:
+            found = find_component(child, component_id)
+            if found is not None:
+                return found
+    elif isinstance(node, dict):
+        return find_component(node, component_id)
+    return None
+
+
+########################################################################################
+################################### Filter sessions ####################################
+########################################################################################
+
+
+# One virtual user's sequence of filter changes, as (action, filter state) pairs
+def generate_session(rng, min_date, max_date, countries, categories):
+    state = {
+        "start_date": min_date,
+        "end_date": max_date,
+        "countries": [],
+        "categories": [],
+    }
+    steps = [("initial", dict(state))]
+
+    # Narrow the date range step by step
+    for _ in range(rng.randint(1, 3)):
+        days = (state["end_date"] - state["start_date"]).days
+        if days < 14:
+            break
+        start_offset = rng.randint(0, days // 3)
+        end_offset = rng.randint(0, days // 3)
+        state["start_date"] += timedelta(days=start_offset)
+        state["end_date"] -= timedelta(days=end_offset)
+        steps.append(("narrow_dates", dict(state)))
+
+    # Add countries one at a time
+    for country in rng.sample(countries, rng.randint(1, min(4, len(countries)))):
+        state["countries"] = state["countries"] + [country]
+        steps.append(("add_country", dict(state)))
+
+    # Toggle categories on and off
+    for _ in range(rng.randint(1, 3)):
+        category = rng.choice(categories)
+        if category in state["categories"]:
+            state["categories"] = [c for c in state["categories"] if c != category]
+        else:
+            state["categories"] = state["categories"] + [category]
+        steps.append(("toggle_category", dict(state)))
+
+    # Cross-filter by clicking a country on the map and a slice of the category pie
+    state["map_click"] = rng.choice(state["countries"])
+    steps.append(("click_country", dict(state)))
+    state["pie_click"] = rng.choice(categories)
+    steps.append(("click_category", dict(state)))
+
+    return steps
+
+
+def input_values(state):
+    return {
+        "date-picker-range.start_date": state["start_date"].isoformat(),
+        "date-picker-range.end_date": state["end_date"].isoformat(),
+        "country-dropdown.value": state["countries"] or None,
+        "category-dropdown.value": state["categories"] or None,
+        "customer-heatmap.clickData": state.get("map_click")
+        and {"points": [{"location": state["map_click"]}]},
+        "sales-category.clickData": state.get("pie_click")
+        and {"points": [{"label": state["pie_click"]}]},
+    }
+
+
+def build_payload(callback, state, changed):
+    values = input_values(state)
+    outputs = [
+        {"id": output.split(".")[0], "property": output.split(".")[1]}
+        for output in callback["output"].strip(".").split("...")
+    ]
+    return {
+        "output": callback["output"],
+        "outputs": outputs,
+        "inputs": [
+            {
+                **dependency,
+                "value": values.get(f"{dependency['id']}.{dependency['property']}"),
+            }
+            for dependency in callback["inputs"]
+        ],
+        "changedPropIds": changed,
+        "state": [
+            {
+                **dependency,
+                "value": values.get(f"{dependency['id']}.{dependency['property']}"),
+            }
+            for dependency in callback["state"]
+        ],
+    }
+
+
+changed_props = {
+    "initial": [],
+    "narrow_dates": ["date-picker-range.start_date", "date-picker-range.end_date"],
+    "add_country": ["country-dropdown.value"],
+    "toggle_category": ["category-dropdown.value"],
+    "click_country": ["customer-heatmap.clickData"],
+    "click_category": ["sales-category.clickData"],
+}
+
+
+########################################################################################
+###################################### Load test #######################################
+########################################################################################
+
+
+def post(url, payload):
+    body = json.dumps(payload).encode()
+    request = urllib.request.Request(
+        f"{url}/_dash-update-component",
+        data=body,
+        headers={"Content-Type": "application/json"},
+    )
+    started = time.perf_counter()
+    with urllib.request.urlopen(request, timeout=120) as response:
+        size = len(response.read())
+    return time.perf_counter() - started, size
+
+
+def run_user(url, callback, sessions, deadline, results, lock):
+    for session in sessions:
+        for action, state in session:
+            if time.time() > deadline:
+                return
+            try:
+                latency, size = post(
+                    url, build_payload(callback, state, changed_props[action])
+                )
+                record = (action, latency, size, None)
+            except Exception as error:
+                record = (action, None, 0, repr(error))
+            with lock:
+                results.append(record)
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def report(results, elapsed):
+    by_action = defaultdict(list)
+    for action, latency, size, error in results:
+        if error is None:
+            by_action[action].append((latency, size))
+            by_action["all"].append((latency, size))
+    errors = [error for _, _, _, error in results if error is not None]
+    completed = len(results) - len(errors)
+
+    print(f"\n{len(results)} requests in {elapsed:.1f}s, {len(errors)} errors")
+    print(f"Throughput: {completed / elapsed:.1f} requests/s")
+    print(
+        f"{'action':<16}{'count':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+        f"{'avg KB':>10}{'max KB':>10}"
+    )
+    for action, samples in sorted(by_action.items(), key=lambda item: item[0] != "all"):
+        latencies = [latency * 1000 for latency, _ in samples]
+        sizes = [size / 1024 for _, size in samples]
+        print(
+            f"{action:<16}{len(samples):>7}"
+            f"{percentile(latencies, 0.50):>10.1f}"
+            f"{percentile(latencies, 0.95):>10.1f}"
+            f"{percentile(latencies, 0.99):>10.1f}"
+            f"{sum(sizes) / len(sizes):>10.1f}{max(sizes):>10.1f}"
+        )
+    for error in sorted(set(errors))[:5]:
+        print("Error:", error)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", help="target a running server instead of starting one")
+    parser.add_argument("--port", type=int, default=8050)
+    parser.add_argument("--workers", type=int, default=2, help="gunicorn workers")
+    parser.add_argument("--threads", type=int, default=1, help="threads per worker")
+    parser.add_argument("--backend", choices=["pandas", "sqlite"], default="pandas")
+    parser.add_argument(
+        "--disk-cache",
+        action="store_true",
+        help="keep the shared disk cache enabled (disabled by default for cold numbers)",
+    )
+    parser.add_argument(
+        "--lazy-startup", action="store_true", help="set DASHBOARD_LAZY_STARTUP=1"
+    )
+    parser.add_argument("--users", type=int, default=8, help="concurrent virtual users")
+    parser.add_argument("--sessions", type=int, default=5, help="sessions per user")
+    parser.add_argument("--duration", type=float, default=60, help="max seconds")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    server = None
+    url = args.url
+    if url is None:
+        url = f"http://127.0.0.1:{args.port}"
+        env = {
+            "DASHBOARD_BACKEND": args.backend,
+            "DASHBOARD_LAZY_STARTUP": "1" if args.lazy_startup else "0",
+        }
+        if not args.disk_cache:
+            env["DASHBOARD_CACHE_PATH"] = ""
+        server = start_server(args.port, args.workers, args.threads, env)
+
+    try:
+        started = time.time()
+        layout = wait_until_ready(url)
+        if server is not None:
+            print(f"Server ready after {time.time() - started:.2f}s")
+        dependencies = fetch_json(f"{url}/_dash-dependencies")
+        callback = next(
+            dependency
+            for dependency in dependencies
+            if "..total-sales.children..." in dependency["output"]
+        )
+        date_picker = find_component(layout, "date-picker-range")
+        min_date = date.fromisoformat(str(date_picker["start_date"])[:10])
+        max_date = date.fromisoformat(str(date_picker["end_date"])[:10])
+        countries = [
+            option["value"]
+            for option in find_component(layout, "country-dropdown")["options"]
+        ]
+        categories = [
+            option["value"]
+            for option in find_component(layout, "category-dropdown")["options"]
+        ]
+
+        rng = random.Random(args.seed)
+        user_sessions = [
+            [
+                generate_session(rng, min_date, max_date, countries, categories)
+                for _ in range(args.sessions)
+            ]
+            for _ in range(args.users)
+        ]
+
+        results = []
+        lock = threading.Lock()
+        started = time.time()
+        deadline = started + args.duration
+        users = [
+            threading.Thread(
+                target=run_user,
+                args=(url, callback, sessions, deadline, results, lock),
+            )
+            for sessions in user_sessions
+        ]
+        for user in users:
+            user.start()
+        for user in users:
+            user.join()
+
+        report(results, time.time() - started)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == "__main__":
+    main()
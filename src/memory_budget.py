@@ -0,0 +1,136 @@
+"""Memory budget check for the update_dashboard callback.
+
+Replays filter-change sessions (see loadtest.py) against the app in this process,
+without the shared disk cache, and exits with status 1 if the process RSS after the
+requests, its growth over the second half of them or the traced peak of a single
+request exceeds its budget. The RSS requests run untraced, the peak requests then
+run under tracemalloc with fresh filter states.
+
+    python memory_budget.py [--requests 100] [--peak-mb 16] [--rss-mb 400]
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+import tracemalloc
+from datetime import date
+
+from cache import wait_for_warm_up
+from loadtest import build_payload, changed_props, find_component, generate_session
+from profiling import format_bytes, rss_bytes
+
+########################################################################################
+###################################### Requests ########################################
+########################################################################################
+
+
+# Endless (action, filter state) steps of random sessions over the app's filter options
+def filter_steps(layout, seed):
+    date_picker = find_component(layout, "date-picker-range")
+    min_date = date.fromisoformat(str(date_picker["start_date"])[:10])
+    max_date = date.fromisoformat(str(date_picker["end_date"])[:10])
+    countries = [
+        option["value"]
+        for option in find_component(layout, "country-dropdown")["options"]
+    ]
+    categories = [
+        option["value"]
+        for option in find_component(layout, "category-dropdown")["options"]
+    ]
+    rng = random.Random(seed)
+    while True:
+        yield from generate_session(rng, min_date, max_date, countries, categories)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--backend", choices=["pandas", "sqlite"], default="pandas")
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--peak-mb", type=float, default=16, help="per request")
+    parser.add_argument("--rss-mb", type=float, default=400, help="after all requests")
+    parser.add_argument(
+        "--rss-growth-mb",
+        type=float,
+        default=20,
+        help="over the second half of the requests",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    os.environ.update(
+        DASHBOARD_BACKEND=args.backend,
+        DASHBOARD_CACHE_PATH="",
+        DASHBOARD_LAZY_STARTUP="0",
+    )
+    from app import app
+
+    client = app.server.test_client()
+    layout = client.get("/_dash-layout").get_json()
+    callback = next(
+        dependency
+        for dependency in client.get("/_dash-dependencies").get_json()
+        if "..total-sales.children..." in dependency["output"]
+    )
+    steps = filter_steps(layout, args.seed)
+
+    def post(action, state):
+        payload = build_payload(callback, state, changed_props[action])
+        response = client.post("/_dash-update-component", json=payload)
+        if response.status_code not in (200, 204):
+            raise RuntimeError(f"{action} failed with HTTP {response.status_code}")
+
+    wait_for_warm_up()
+    rss_started = rss_bytes()
+    for request in range(args.requests):
+        if request == args.requests // 2:
+            rss_halfway = rss_bytes()
+        post(*next(steps))
+    rss_finished = rss_bytes()
+
+    tracemalloc.start()
+    peaks = []
+    for _ in range(args.requests):
+        action, state = next(steps)
+        current = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        started = time.perf_counter()
+        post(action, state)
+        seconds = time.perf_counter() - started
+        peaks.append((tracemalloc.get_traced_memory()[1] - current, action, seconds))
+    tracemalloc.stop()
+    peak, action, seconds = max(peaks)
+
+    print(f"RSS before the requests: {format_bytes(rss_started)}")
+    if rss_finished is None:
+        print("RSS is not available on this platform, only checking peaks")
+    budgets = [
+        (
+            f"Largest request peak ({action}, {seconds * 1000:.0f} ms)",
+            peak,
+            args.peak_mb,
+        ),
+    ]
+    if rss_finished is not None:
+        budgets += [
+            (f"RSS after {args.requests} requests", rss_finished, args.rss_mb),
+            (
+                "RSS growth over the second half",
+                rss_finished - rss_halfway,
+                args.rss_growth_mb,
+            ),
+        ]
+    failed = False
+    for name, size, budget_mb in budgets:
+        over = size > budget_mb * 2**20
+        failed |= over
+        print(
+            f"{name}: {format_bytes(size)} "
+            f"({'over' if over else 'within'} the {budget_mb:g} MB budget)"
+        )
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+import functools
+import os
+import threading
+import tracemalloc
+from contextlib import contextmanager
+
+########################################################################################
+################################## Memory profiling ####################################
+########################################################################################
+
+# With DASHBOARD_MEMORY_PROFILE=1, loading a dataset and every dashboard update print
+# their traced peak and retained memory, the process RSS and the lines that allocated
+# the most, each attributed to the dashboard code that led there. Tracing slows the
+# worker down severalfold, every report compares two snapshots of the whole heap
+# (seconds) and the figures of stages running at the same time include each other's
+# allocations: this is for finding leaks, not for production. RSS includes the traces,
+# memory_budget.py measures it untraced.
+memory_profiling = os.environ.get("DASHBOARD_MEMORY_PROFILE", "") not in ("", "0")
+
+# Allocation sites listed per stage, and traceback depth recorded per allocation
+top_allocations = 10
+traced_frames = 25
+
+base_dir = os.path.dirname(os.path.abspath(__file__))
+
+# tracemalloc has a single, process-wide peak: every stage that starts resets it, after
+# saving it in the `peak` of the stages in progress (nested or in other threads) so
+# they do not lose it. Only this bookkeeping is locked, not the profiled code, which may
+# wait on locks of its own (e.g. a dataset loading while an update waits for it).
+_lock = threading.Lock()
+
+
+class _Stage:
+    # A stage in progress, compared by identity: stages may have the same peak
+    peak = 0
+
+
+_stages = set()
+
+if memory_profiling:
+    tracemalloc.start(traced_frames)
+
+
+# Resident set size of this process in bytes, None where /proc is not available
+def rss_bytes():
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+
+def format_frame(frame):
+    return f"{os.path.relpath(frame.filename, base_dir)}:{frame.lineno}"
+
+
+# The line that allocated, and the innermost line of the dashboard code above it
+def allocation_site(traceback):
+    site = format_frame(traceback[-1])
+    for frame in reversed(traceback):
+        if frame.filename.startswith(base_dir) and frame.filename != __file__:
+            caller = format_frame(frame)
+            return site if caller == site else f"{site} via {caller}"
+    return site
+
+
+# Net bytes and blocks allocated between two snapshots, grouped by allocation_site
+def allocation_report(before, after, limit=top_allocations):
+    sites = {}
+    for stat in after.compare_to(before, "traceback"):
+        # Leave out the `before` snapshot itself
+        if not stat.size_diff or stat.traceback[-1].filename == tracemalloc.__file__:
+            continue
+        site = allocation_site(stat.traceback)
+        size, count = sites.get(site, (0, 0))
+        sites[site] = (size + stat.size_diff, count + stat.count_diff)
+    return sorted(sites.items(), key=lambda item: item[1][0], reverse=True)[:limit]
+
+
+def format_bytes(size):
+    return "n/a" if size is None else f"{size / 2**20:.1f} MB"
+
+
+# Measure the memory of the enclosed code under `stage` if profiling is enabled
+@contextmanager
+def profile_stage(stage):
+    if not memory_profiling:
+        yield
+        return
+
+    before = tracemalloc.take_snapshot()
+    rss_before = rss_bytes()
+    with _lock:
+        started_at, peak = tracemalloc.get_traced_memory()
+        for other in _stages:
+            other.peak = max(other.peak, peak)
+        current = _Stage()
+        _stages.add(current)
+        tracemalloc.reset_peak()
+    try:
+        yield
+    finally:
+        with _lock:
+            retained, peak = tracemalloc.get_traced_memory()
+            _stages.remove(current)
+            peak = max(current.peak, peak)
+        rss_after = rss_bytes()
+        after = tracemalloc.take_snapshot()
+        print(
+            f"Memory of {stage}: peak +{format_bytes(peak - started_at)}, "
+            f"retained {retained - started_at:+,} bytes, "
+            f"RSS {format_bytes(rss_before)} -> {format_bytes(rss_after)}"
+        )
+        for site, (size, count) in allocation_report(before, after):
+            print(f"    {size:+12,} bytes {count:+8,} blocks  {site}")
+
+
+# Decorator form of profile_stage
+def profiled(stage):
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with profile_stage(stage):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator